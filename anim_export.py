@@ -0,0 +1,304 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, List, Optional
+from PIL import GifImagePlugin, Image
+import numpy as np
+import mktypes
+import graph_util
+
+GIF = 'gif'
+APNG = 'apng'
+WEBP = 'webp'
+
+EXTENSIONS = {'.gif': GIF, '.png': APNG, '.apng': APNG, '.webp': WEBP}
+
+
+@dataclass(slots=True)
+class Frame:
+    '''Region of an animation frame that changed since the previous one.'''
+    # "P" mode, palette indices only
+    image: Image.Image
+    x: int
+    y: int
+    # milliseconds
+    duration: int
+
+
+def FrameTime(index: int, fps: float) -> int:
+    '''Start of the frame in milliseconds, rounding doesn't accumulate.'''
+    return round(index * 1000 / fps)
+
+
+def IndexedFrames(sprites: List[mktypes.SpriteDescriptor],
+                  clipping_box: mktypes.ClippingBox,
+                  transparent_index: Optional[int]) -> Iterator[np.ndarray]:
+    '''Palette indices of the full frames, composed one at a time into a
+    single reused frame buffer.
+    '''
+    size = clipping_box.width * clipping_box.height
+    frame = mktypes.PixelBuffer(clipping_box.width, clipping_box.height,
+                                bytearray(size), bytearray(size))
+    for sprite in sprites:
+        graph_util.FillFrame(frame, -1)
+        graph_util.Blit(frame, sprite.data,
+                        *graph_util.ClippingBoxOffset(sprite, clipping_box))
+        yield np.frombuffer(graph_util.IndexedPixels(frame, transparent_index),
+                            dtype=np.uint8).reshape(
+                                (clipping_box.height, clipping_box.width))
+
+
+def DeltaFrames(sprites: List[mktypes.SpriteDescriptor],
+                clipping_box: mktypes.ClippingBox,
+                transparent_index: Optional[int],
+                fps: float) -> Iterator[Frame]:
+    '''Frames cropped to the bounding box of pixels that differ from the
+    previous frame, the first one is complete. Frames without changes
+    extend the duration of the previous one. Only the previous frame and
+    the one not yielded yet are kept.
+    '''
+    previous: Optional[np.ndarray] = None
+    pending: Optional[Frame] = None
+    for index, indices in enumerate(
+            IndexedFrames(sprites, clipping_box, transparent_index)):
+        duration = FrameTime(index + 1, fps) - FrameTime(index, fps)
+        x0, y0 = 0, 0
+        y1, x1 = indices.shape
+        if previous is not None:
+            changed = indices != previous
+            rows = np.flatnonzero(changed.any(axis=1))
+            if not len(rows):
+                assert pending is not None
+                pending.duration += duration
+                continue
+            columns = np.flatnonzero(changed.any(axis=0))
+            x0, x1 = int(columns[0]), int(columns[-1]) + 1
+            y0, y1 = int(rows[0]), int(rows[-1]) + 1
+        if pending is not None:
+            yield pending
+        region = np.ascontiguousarray(indices[y0:y1, x0:x1])
+        pending = Frame(
+            Image.frombytes('P', (x1 - x0, y1 - y0), region.tobytes()), x0,
+            y0, duration)
+        previous = indices
+    if pending is not None:
+        yield pending
+
+
+class GifWriter:
+    '''Writes GIF frames as they come: one global color table, frames are
+    drawn over the previous ones (disposal 1), LZW compression is done by
+    Pillow.
+    '''
+    def __init__(self,
+                 fp: BinaryIO,
+                 width: int,
+                 height: int,
+                 palette: bytes,
+                 loop: int = 0) -> None:
+        self.fp = fp
+        # delays are in 1/100 s, rounding is done on the running total
+        self.elapsed_ms = 0
+        self.elapsed_cs = 0
+        # global color table of 256 entries
+        fp.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0xF7, 0, 0))
+        fp.write(palette.ljust(768, b'\x00'))
+        fp.write(b'!\xFF\x0BNETSCAPE2.0\x03\x01' + struct.pack('<H', loop) +
+                 b'\x00')
+
+    def AddFrame(self, frame: Frame) -> None:
+        self.elapsed_ms += frame.duration
+        delay = round(self.elapsed_ms / 10) - self.elapsed_cs
+        self.elapsed_cs += delay
+        for chunk in GifImagePlugin.getdata(frame.image, (frame.x, frame.y),
+                                            duration=delay * 10,
+                                            disposal=1):
+            self.fp.write(chunk)
+
+    def Close(self) -> None:
+        self.fp.write(b';')
+
+
+def PngChunk(kind: bytes, data: bytes) -> bytes:
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data)))
+
+
+class ApngWriter:
+    '''Writes palette mode APNG frames as they come. Every frame replaces
+    its region (blend SOURCE) and stays in place (dispose NONE). The frame
+    count in acTL is patched on Close, so fp must be seekable.
+    '''
+    def __init__(self,
+                 fp: BinaryIO,
+                 width: int,
+                 height: int,
+                 palette: bytes,
+                 loop: int = 0) -> None:
+        self.fp = fp
+        self.loop = loop
+        self.frames = 0
+        self.sequence = 0
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        fp.write(
+            PngChunk(b'IHDR',
+                     struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)))
+        fp.write(PngChunk(b'PLTE', palette))
+        self.actl_position = fp.tell()
+        fp.write(PngChunk(b'acTL', struct.pack('>II', 0, loop)))
+
+    def AddFrame(self, frame: Frame) -> None:
+        width, height = frame.image.size
+        delay_num, delay_den = frame.duration, 1000
+        if delay_num > 0xFFFF:
+            delay_num, delay_den = round(frame.duration / 10), 100
+        self.fp.write(
+            PngChunk(
+                b'fcTL',
+                struct.pack('>IIIIIHHBB', self.sequence, width, height,
+                            frame.x, frame.y, min(delay_num, 0xFFFF),
+                            delay_den, 0, 0)))
+        self.sequence += 1
+        # every row starts with filter type 0 (None)
+        rows = np.zeros((height, width + 1), dtype=np.uint8)
+        rows[:, 1:] = np.frombuffer(frame.image.tobytes(),
+                                    dtype=np.uint8).reshape((height, width))
+        data = zlib.compress(rows.tobytes())
+        if self.frames == 0:
+            self.fp.write(PngChunk(b'IDAT', data))
+        else:
+            self.fp.write(
+                PngChunk(b'fdAT', struct.pack('>I', self.sequence) + data))
+            self.sequence += 1
+        self.frames += 1
+
+    def Close(self) -> None:
+        self.fp.write(PngChunk(b'IEND', b''))
+        end = self.fp.tell()
+        self.fp.seek(self.actl_position)
+        self.fp.write(
+            PngChunk(b'acTL', struct.pack('>II', self.frames, self.loop)))
+        self.fp.seek(end)
+
+
+def IndicesToRgb(indices: np.ndarray, palette: bytes) -> Image.Image:
+    image = Image.frombytes('P', (indices.shape[1], indices.shape[0]),
+                            indices.tobytes())
+    image.putpalette(palette)
+    return image.convert('RGB')
+
+
+class _FrameSequence(Image.Image):
+    '''Multi-frame image whose frames are rendered on seek, lets Pillow's
+    WebP encoder consume frames one at a time instead of a list of images.
+    Frames must be visited in order.
+    '''
+    def __init__(self, frames: Iterator[np.ndarray], count: int,
+                 palette: bytes) -> None:
+        super().__init__()
+        self.frames = frames
+        self.n_frames = count
+        self.palette_rgb = palette
+        self.frame_index = -1
+        self.seek(0)
+
+    def seek(self, frame: int) -> None:
+        if frame == self.frame_index:
+            return
+        assert frame == self.frame_index + 1, 'frames must be read in order'
+        image = IndicesToRgb(next(self.frames), self.palette_rgb)
+        self.im = image.im
+        self._mode = image.mode
+        self._size = image.size
+        self.frame_index = frame
+
+    def tell(self) -> int:
+        return self.frame_index
+
+
+def SaveWebp(file_name: str, sprites: List[mktypes.SpriteDescriptor],
+             clipping_box: mktypes.ClippingBox,
+             transparent_index: Optional[int], palette: bytes,
+             fps: float) -> None:
+    '''Lossless, so the game palette colors are kept exactly. libwebp does
+    its own sub-frame optimization, full frames are passed to it.
+    '''
+    frames = IndexedFrames(sprites, clipping_box, transparent_index)
+    first = IndicesToRgb(next(frames), palette)
+    rest = []
+    if len(sprites) > 1:
+        rest = [_FrameSequence(frames, len(sprites) - 1, palette)]
+    first.save(file_name,
+               format='WEBP',
+               save_all=True,
+               append_images=rest,
+               duration=[
+                   FrameTime(i + 1, fps) - FrameTime(i, fps)
+                   for i in range(len(sprites))
+               ],
+               lossless=True,
+               loop=0)
+
+
+def FormatFromFileName(file_name: str) -> str:
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension not in EXTENSIONS:
+        raise ValueError('unknown animation format: %s' % extension)
+    return EXTENSIONS[extension]
+
+
+def SaveAnimation(file_name: str,
+                  sprites: List[mktypes.SpriteDescriptor],
+                  lut: graph_util.PaletteLut,
+                  fps: float,
+                  format: Optional[str] = None) -> None:
+    '''Exports sprites as an animation (format is guessed from the file
+    extension by default). Frames use the game palette as is, transparent
+    pixels get the transparent color of lut.
+    '''
+    if not sprites:
+        raise ValueError('no sprites to save')
+    if format is None:
+        format = FormatFromFileName(file_name)
+    clipping_box = graph_util.CalculateClippingBox(sprites)
+    transparent_index = graph_util.FreeIndex([s.data for s in sprites])
+    palette = lut.Rgb(transparent_index)
+    tmp_name = file_name + '.tmp'
+    try:
+        if format == WEBP:
+            SaveWebp(tmp_name, sprites, clipping_box, transparent_index,
+                     palette, fps)
+        else:
+            with open(tmp_name, 'wb') as fp:
+                writer_class = GifWriter if format == GIF else ApngWriter
+                writer = writer_class(fp, clipping_box.width,
+                                      clipping_box.height, palette)
+                for frame in DeltaFrames(sprites, clipping_box,
+                                         transparent_index, fps):
+                    writer.AddFrame(frame)
+                writer.Close()
+        os.replace(tmp_name, file_name)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
@@ -0,0 +1,155 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+import tkinter as tk
+from dataclasses import dataclass
+from typing import Callable, Hashable, List, Optional
+from PIL import ImageTk
+import lru
+import render_cache
+
+# Default budget for cached animation frames.
+DEFAULT_FRAMES_CACHE_BYTES = 128 * 1024 * 1024
+
+
+@dataclass(slots=True)
+class PlaybackStats:
+    fps: float = 0.0
+    frames_shown: int = 0
+    frames_dropped: int = 0
+
+
+def FramesSize(frames: List[render_cache.RenderedImage]) -> int:
+    return sum(render_cache.RenderedImageSize(frame) for frame in frames)
+
+
+class AnimationEngine:
+    '''Plays pre-rendered frames on a canvas. Frames are scheduled from the
+    Tk event loop with after(), every frame deadline is computed from the
+    playback start, so timer jitter doesn't accumulate. Frames whose
+    deadline already passed are skipped and counted as dropped.
+    '''
+    # how often on_stats is called, in seconds
+    STATS_INTERVAL = 1.0
+
+    def __init__(
+            self,
+            canvas: tk.Canvas,
+            on_stats: Optional[Callable[[PlaybackStats], None]] = None,
+            cache_bytes: int = DEFAULT_FRAMES_CACHE_BYTES) -> None:
+        self.canvas = canvas
+        self.on_stats = on_stats
+        self.frames_cache = lru.ByteLru(cache_bytes, FramesSize)
+        self.frames: List[ImageTk.PhotoImage] = []
+        self.fps = 12.0
+        self.stats = PlaybackStats()
+        self.item: Optional[int] = None
+        self.after_id: Optional[str] = None
+        self.start = 0.0
+        # number of frame periods elapsed when the last frame was shown
+        self.position = -1
+        self.window_start = 0.0
+        self.window_frames = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self.frames)
+
+    def GetFrames(
+        self, key: Hashable, render: Callable[[],
+                                              List[render_cache.RenderedImage]]
+    ) -> List[render_cache.RenderedImage]:
+        '''Frames cached under key, render is called only on a miss. key
+        should identify sprites and scale, the palette is set by the caller.
+        '''
+        frames = self.frames_cache.Get(key)
+        if frames is None:
+            frames = render()
+            self.frames_cache.Put(key, frames)
+        return frames
+
+    def ClearCache(self) -> None:
+        self.frames_cache.Clear()
+
+    def Play(self, frames: List[ImageTk.PhotoImage], fps: float) -> None:
+        self.Stop()
+        if not frames:
+            return
+        self.frames = frames
+        self.fps = fps
+        self.stats = PlaybackStats()
+        self.item = self.canvas.create_image(0,
+                                             0,
+                                             image=frames[0],
+                                             anchor=tk.NW)
+        self.start = self.window_start = time.perf_counter()
+        self.position = -1
+        self.window_frames = 0
+        self.__tick()
+
+    def SetFps(self, fps: float) -> None:
+        '''Changes the speed without restarting the animation.'''
+        if fps == self.fps:
+            return
+        if self.running:
+            now = time.perf_counter()
+            elapsed = (now - self.start) * self.fps / fps
+            self.start = now - elapsed
+        self.fps = fps
+        if self.running:
+            self.__schedule()
+
+    def Stop(self) -> None:
+        if self.after_id is not None:
+            self.canvas.after_cancel(self.after_id)
+            self.after_id = None
+        if self.item is not None:
+            self.canvas.delete(self.item)
+            self.item = None
+        self.frames = []
+
+    def __tick(self) -> None:
+        self.after_id = None
+        now = time.perf_counter()
+        position = int((now - self.start) * self.fps)
+        if position > self.position:
+            self.stats.frames_dropped += max(0, position - self.position - 1)
+            self.stats.frames_shown += 1
+            self.window_frames += 1
+            self.position = position
+            assert self.item is not None
+            self.canvas.itemconfigure(self.item,
+                                      image=self.frames[position %
+                                                        len(self.frames)])
+        if now - self.window_start >= AnimationEngine.STATS_INTERVAL:
+            self.stats.fps = self.window_frames / (now - self.window_start)
+            self.window_start = now
+            self.window_frames = 0
+            if self.on_stats is not None:
+                self.on_stats(self.stats)
+        self.__schedule()
+
+    def __schedule(self) -> None:
+        if self.after_id is not None:
+            self.canvas.after_cancel(self.after_id)
+        deadline = self.start + (self.position + 1) / self.fps
+        delay = round((deadline - time.perf_counter()) * 1000)
+        self.after_id = self.canvas.after(max(1, delay), self.__tick)
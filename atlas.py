@@ -0,0 +1,222 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import json
+import math
+import os
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Tuple
+from PIL import Image
+import numpy as np
+import mktypes
+import graph_util
+
+
+@dataclass(slots=True)
+class AtlasEntry:
+    '''Placement of a sprite in the atlas. The width x height pixels at
+    (x, y) of the atlas come from (source_x, source_y) of the original
+    source_width x source_height sprite (smaller when trimmed); anchor is
+    the sprite x/y from its descriptor.
+    '''
+    offset: int
+    x: int
+    y: int
+    width: int
+    height: int
+    source_x: int
+    source_y: int
+    source_width: int
+    source_height: int
+    anchor_x: int
+    anchor_y: int
+
+
+@dataclass(slots=True)
+class Atlas:
+    image: Image.Image
+    entries: List[AtlasEntry]
+    palette_offset: int
+    # palette index of transparent pixels, None when all indices are used
+    transparent_index: Optional[int]
+
+
+class SkylinePacker:
+    '''Bottom-left skyline packing into a strip of fixed width.'''
+    def __init__(self, width: int) -> None:
+        self.width = width
+        self.height = 0
+        # (x, y, width) segments covering the whole strip width
+        self.skyline: List[Tuple[int, int, int]] = [(0, 0, width)]
+
+    def __fitAt(self, index: int, width: int) -> Optional[int]:
+        '''Lowest y a rectangle placed at the start of the segment can
+        have.
+        '''
+        x = self.skyline[index][0]
+        if x + width > self.width:
+            return None
+        y = 0
+        left = width
+        while left > 0:
+            _, segment_y, segment_width = self.skyline[index]
+            y = max(y, segment_y)
+            left -= segment_width
+            index += 1
+        return y
+
+    def Insert(self, width: int, height: int) -> Tuple[int, int]:
+        best = None
+        for index in range(len(self.skyline)):
+            y = self.__fitAt(index, width)
+            if y is None:
+                continue
+            key = (y + height, self.skyline[index][0])
+            if best is None or key < best[0]:
+                best = (key, index, y)
+        assert best is not None, 'rectangle wider than the atlas'
+        _, index, y = best
+        x = self.skyline[index][0]
+        self.__place(index, x, y + height, width)
+        self.height = max(self.height, y + height)
+        return x, y
+
+    def __place(self, index: int, x: int, top: int, width: int) -> None:
+        end = x + width
+        segments = self.skyline[:index] + [(x, top, width)]
+        for segment_x, segment_y, segment_width in self.skyline[index:]:
+            segment_end = segment_x + segment_width
+            if segment_end <= end:
+                continue
+            if segment_x < end:
+                segment_x, segment_width = end, segment_end - end
+            segments.append((segment_x, segment_y, segment_width))
+        # merge neighbours of the same height
+        self.skyline = []
+        for segment in segments:
+            if self.skyline and self.skyline[-1][1] == segment[1]:
+                last = self.skyline[-1]
+                self.skyline[-1] = (last[0], last[1], last[2] + segment[2])
+            else:
+                self.skyline.append(segment)
+
+
+def TrimRect(buf: mktypes.PixelBuffer) -> Tuple[int, int, int, int]:
+    '''(x, y, width, height) of the smallest rectangle containing all opaque
+    pixels.
+    '''
+    if buf.alpha is None or not buf.width or not buf.height:
+        return 0, 0, buf.width, buf.height
+    opaque = np.frombuffer(buf.alpha, dtype=np.uint8).reshape(
+        (buf.height, buf.width)) != 0
+    rows = np.flatnonzero(opaque.any(axis=1))
+    if not len(rows):
+        return 0, 0, 0, 0
+    columns = np.flatnonzero(opaque.any(axis=0))
+    return (int(columns[0]), int(rows[0]), int(columns[-1] - columns[0] + 1),
+            int(rows[-1] - rows[0] + 1))
+
+
+def AtlasWidth(rects: List[Tuple[int, int, int, int]], max_width: int) -> int:
+    '''Roughly square atlas, but never narrower than the widest sprite.'''
+    widest = max((r[2] for r in rects), default=0)
+    area = sum(r[2] * r[3] for r in rects)
+    width = (int(math.sqrt(area * 1.1)) + 15) & ~15
+    return max(widest, min(width, max_width), 1)
+
+
+def BuildAtlas(sprites: List[mktypes.SpriteDescriptor],
+               palette: mktypes.Palette,
+               max_width: int = 1024,
+               trim: bool = True) -> Atlas:
+    '''Packs sprites (tallest first) with SkylinePacker and blits them in a
+    single pass into a palette mode image.
+    '''
+    buffers = [sprite.data for sprite in sprites]
+    rects = [
+        TrimRect(buf) if trim else (0, 0, buf.width, buf.height)
+        for buf in buffers
+    ]
+    packer = SkylinePacker(AtlasWidth(rects, max_width))
+    positions = [(0, 0)] * len(sprites)
+    for i in sorted(range(len(sprites)),
+                    key=lambda i: (-rects[i][3], -rects[i][2])):
+        if rects[i][2] and rects[i][3]:
+            positions[i] = packer.Insert(rects[i][2], rects[i][3])
+
+    transparent_index = graph_util.FreeIndex(buffers)
+
+    # sprites trimmed to nothing leave an empty atlas, image formats need
+    # at least one (transparent) pixel
+    height = max(packer.height, 1)
+    pixels = np.full((height, packer.width),
+                     0 if transparent_index is None else transparent_index,
+                     dtype=np.uint8)
+    entries = []
+    for sprite, buf, (x, y), (sx, sy, w, h) in zip(sprites, buffers,
+                                                   positions, rects):
+        entries.append(
+            AtlasEntry(sprite.offset, x, y, w, h, sx, sy, sprite.width,
+                       sprite.height, sprite.x, sprite.y))
+        if not w or not h:
+            continue
+        src = (slice(sy, sy + h), slice(sx, sx + w))
+        pixels[y:y + h, x:x + w] = np.frombuffer(
+            graph_util.IndexedPixels(buf, transparent_index),
+            dtype=np.uint8).reshape((buf.height, buf.width))[src]
+
+    image = Image.frombuffer('P', (packer.width, height),
+                             pixels.tobytes(), 'raw', 'P', 0, 1)
+    if transparent_index is not None:
+        image.info['transparency'] = transparent_index
+    image.putpalette(
+        graph_util.GetPaletteLut(palette).Rgb(transparent_index))
+    return Atlas(image, entries, palette.offset, transparent_index)
+
+
+def SidecarFileName(image_file_name: str) -> str:
+    return os.path.splitext(image_file_name)[0] + '.json'
+
+
+def SaveSidecar(atlas: Atlas,
+                image_file_name: str,
+                options: Optional[dict] = None) -> None:
+    '''JSON description of the atlas, stored next to the image. options
+    (e.g. the settings the atlas was built with) are stored as they are.
+    '''
+    sidecar = {
+        'image': os.path.basename(image_file_name),
+        'width': atlas.image.width,
+        'height': atlas.image.height,
+        'palette_offset': atlas.palette_offset,
+        'transparent_index': atlas.transparent_index,
+        'sprites': [asdict(entry) for entry in atlas.entries],
+    }
+    if options is not None:
+        sidecar['options'] = options
+    with open(SidecarFileName(image_file_name), 'w') as f:
+        json.dump(sidecar, f, indent=1)
+
+
+def SaveAtlas(atlas: Atlas,
+              image_file_name: str,
+              options: Optional[dict] = None) -> None:
+    SaveSidecar(atlas, image_file_name, options)
+    atlas.image.save(image_file_name)
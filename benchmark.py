@@ -0,0 +1,321 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+import mktypes
+import mkexec
+import grafile
+import graph_util
+import synthdata
+
+MEGABYTE = 1000 * 1000
+DEFAULT_THRESHOLD = 0.15
+
+
+@dataclass(slots=True)
+class Stage:
+    name: str
+    run: Callable[[], None]
+    # work done by a single run, per unit (e.g. 'sprites': 1200)
+    amounts: Dict[str, float]
+
+
+@dataclass(slots=True)
+class StageResult:
+    seconds: float
+    peak_memory: int
+    throughput: Dict[str, float] = field(default_factory=dict)
+
+    def ToJson(self) -> dict:
+        return {
+            'seconds': self.seconds,
+            'peak_memory': self.peak_memory,
+            'throughput': self.throughput
+        }
+
+
+def BestTime(run: Callable[[], None], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def PeakMemory(run: Callable[[], None]) -> int:
+    '''Peak of Python allocations during a single run (worker processes are
+    not traced). Kept separate from timing, tracemalloc slows code down.
+    '''
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def Measure(stage: Stage, repeat: int) -> StageResult:
+    seconds = BestTime(stage.run, repeat)
+    result = StageResult(seconds, PeakMemory(stage.run))
+    for unit, amount in stage.amounts.items():
+        result.throughput[unit + '/s'] = amount / max(seconds, 1e-9)
+    return result
+
+
+class Pipeline:
+    '''Loads the data set once and builds the stages, each one works on the
+    output of the previous ones.
+    '''
+    def __init__(self, exe_file_name: str, gra_files: List[str],
+                 jobs: int) -> None:
+        self.exe_file_name = exe_file_name
+        self.gra_files = gra_files
+        self.jobs = jobs
+        self.mkobj = self.__scan()
+        self.descriptors = self.mkobj.FindFileIds(gra_files)
+        self.gras = self.__open()
+        # per GRA file, in the same order as self.gras
+        self.sprites = [list(gra.sprites.values()) for gra in self.gras]
+        try:
+            if not self.__allSprites():
+                raise ValueError('no sprites found in the GRA files')
+            # expands pixels of all sprites, later stages access sprite.data
+            self.pixels = sum(
+                len(sprite.data.pixels) for sprite in self.__allSprites())
+            self.palette = self.__palette()
+        except:
+            self.Close()
+            raise
+
+    def __scan(self) -> mkexec.MkExec:
+        return mkexec.MkExec(self.exe_file_name,
+                             use_cache=False,
+                             jobs=self.jobs)
+
+    def __open(self) -> List[grafile.GraFile]:
+        return [
+            grafile.GraFile(self.mkobj, file_name, gra_descriptor=descriptor)
+            for file_name, descriptor in zip(self.gra_files, self.descriptors)
+        ]
+
+    def __allSprites(self) -> List[mktypes.SpriteDescriptor]:
+        return [sprite for sprites in self.sprites for sprite in sprites]
+
+    def __palette(self) -> mktypes.Palette:
+        colors = max((sprite.number_of_colors
+                      for sprite in self.__allSprites()),
+                     default=0)
+        for palette in self.mkobj.GetSuitablePalettes(colors).values():
+            return palette
+        raise ValueError('no suitable palette')
+
+    def __scanFileIds(self) -> None:
+        # a fresh object, FindFileIds caches the file size lookup
+        mkobj = mkexec.MkExec(self.exe_file_name,
+                              scan_results=self.mkobj.GetScanResults())
+        mkobj.FindFileIds(self.gra_files)
+
+    def __decode(self) -> None:
+        for gra, sprites in zip(self.gras, self.sprites):
+            for sprite in sprites:
+                grafile.DecodePixels(gra.data[sprite.offset:], sprite.width,
+                                     sprite.height)
+
+    def __colorize(self) -> None:
+        for sprite in self.__allSprites():
+            graph_util.ApplyPalette(sprite.data, self.palette)
+
+    def __clip(self) -> None:
+        for sprites in filter(None, self.sprites):
+            box = graph_util.CalculateClippingBox(sprites)
+            for sprite in sprites:
+                graph_util.AddClippingBox(sprite, box, 0)
+
+    def __sheets(self) -> None:
+        for sprites in filter(None, self.sprites):
+            graph_util.GetSpritesImage(sprites, self.palette)
+
+    def __closeAll(self, gras: List[grafile.GraFile]) -> None:
+        for gra in gras:
+            gra.Close()
+
+    def Stages(self) -> List[Stage]:
+        sprites = self.__allSprites()
+        return [
+            Stage('scan', lambda: self.__scan().Close(),
+                  {'MB': os.path.getsize(self.exe_file_name) / MEGABYTE}),
+            Stage('file_ids', self.__scanFileIds,
+                  {'files': len(self.gra_files)}),
+            Stage('gra_open', lambda: self.__closeAll(self.__open()),
+                  {'sprites': len(sprites)}),
+            Stage('decode', self.__decode, {
+                'sprites': len(sprites),
+                'pixels': self.pixels
+            }),
+            Stage('colorize', self.__colorize, {'pixels': self.pixels}),
+            Stage('clipping_box', self.__clip, {'sprites': len(sprites)}),
+            Stage('sprites_image', self.__sheets, {
+                'sprites': len(sprites),
+                'pixels': self.pixels
+            }),
+        ]
+
+    def Close(self) -> None:
+        self.__closeAll(self.gras)
+        self.mkobj.Close()
+
+
+def FindRegressions(results: dict, baseline: dict,
+                    threshold: float) -> List[str]:
+    '''Throughput below baseline * (1 - threshold) or peak memory above
+    baseline * (1 + threshold).
+    '''
+    regressions = []
+    for name, base in baseline['stages'].items():
+        current = results['stages'].get(name)
+        if current is None:
+            regressions.append('%s: stage missing' % name)
+            continue
+        for unit, value in base['throughput'].items():
+            now = current['throughput'].get(unit, 0.0)
+            if now < value * (1 - threshold):
+                regressions.append('%s: %.4g %s, baseline %.4g (%+.1f%%)' %
+                                   (name, now, unit, value,
+                                    100.0 * (now - value) / value))
+        if current['peak_memory'] > base['peak_memory'] * (1 + threshold):
+            regressions.append(
+                '%s: peak memory %d bytes, baseline %d (%+.1f%%)' %
+                (name, current['peak_memory'], base['peak_memory'], 100.0 *
+                 (current['peak_memory'] - base['peak_memory']) /
+                 max(1, base['peak_memory'])))
+    return regressions
+
+
+def PrintResults(results: dict) -> None:
+    for name, result in results['stages'].items():
+        rates = ', '.join('%.4g %s' % (value, unit)
+                          for unit, value in result['throughput'].items())
+        print('%-14s %9.4f s  %8.1f KiB peak  %s' %
+              (name, result['seconds'], result['peak_memory'] / 1024, rates))
+
+
+def Run(data_dir: str, args: argparse.Namespace) -> dict:
+    if args.data is None:
+        exe_file_name, gra_files = synthdata.Generate(data_dir, args.seed,
+                                                      args.exe_size,
+                                                      args.files, args.sprites)
+    else:
+        exe_file_name = os.path.join(args.data, 'MK.EXE')
+        gra_dir = os.path.join(args.data, 'GRAPHICS')
+        gra_files = sorted(
+            os.path.join(gra_dir, name) for name in os.listdir(gra_dir)
+            if name.upper().endswith('.GRA'))
+    pipeline = Pipeline(exe_file_name, gra_files, args.jobs)
+    try:
+        stages = {
+            stage.name: Measure(stage, args.repeat).ToJson()
+            for stage in pipeline.Stages()
+        }
+    finally:
+        pipeline.Close()
+    return {
+        'params': {
+            'data': args.data,
+            'seed': args.seed,
+            'exe_size': os.path.getsize(exe_file_name),
+            'files': len(gra_files),
+            'sprites': sum(len(s) for s in pipeline.sprites),
+            'jobs': args.jobs,
+            'repeat': args.repeat
+        },
+        'stages': stages
+    }
+
+
+def Main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Measures throughput of the viewer pipeline stages on '
+        'generated (or given) data.')
+    parser.add_argument('--data',
+                        help='directory with MK.EXE and GRAPHICS/*.GRA, '
+                        'generated data is used by default')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--exe-size', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--files', type=int, default=6)
+    parser.add_argument('--sprites',
+                        type=int,
+                        default=30,
+                        help='sprites per generated GRA file')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('-r',
+                        '--repeat',
+                        type=int,
+                        default=3,
+                        help='runs per stage, the best time is reported')
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('--save-baseline',
+                        metavar='FILE',
+                        help='store results as the baseline')
+    parser.add_argument('--baseline',
+                        metavar='FILE',
+                        help='compare results with the baseline')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown, fraction of the baseline')
+    args = parser.parse_args(argv)
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='mkbench') as data_dir:
+            results = Run(data_dir, args)
+    except (ValueError, OSError) as e:
+        print('Benchmark failed: %s' % e, file=sys.stderr)
+        return 1
+    PrintResults(results)
+    for file_name in (args.output, args.save_baseline):
+        if file_name:
+            with open(file_name, 'w') as f:
+                json.dump(results, f, indent=1)
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    # the number of runs doesn't change what is measured
+    if any(baseline['params'].get(key) != value
+           for key, value in results['params'].items() if key != 'repeat'):
+        print('Warning: baseline was measured with different parameters.',
+              file=sys.stderr)
+    regressions = FindRegressions(results, baseline, args.threshold)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
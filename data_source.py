@@ -0,0 +1,64 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from typing import Optional
+import mmap
+
+
+class DataSource:
+    '''Read-only contents of a file exposed as a memoryview. The file is
+    memory mapped, so pages are read on first access and shared through the
+    OS page cache between processes mapping the same file.
+    '''
+    def __init__(self, file_name: str) -> None:
+        self.file_name = file_name
+        self.mapping: Optional[mmap.mmap] = None
+        with open(file_name, 'rb') as f:
+            try:
+                self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                self.mapping = None
+        self.view = memoryview(self.mapping if self.mapping is not None else b'')
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+    def __enter__(self) -> 'DataSource':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.Close()
+
+    def Close(self) -> None:
+        '''Unmaps the file. When slices of the view (or arrays created from
+        it) are still referenced, the mapping stays alive until they are
+        garbage collected.
+        '''
+        try:
+            self.view.release()
+        except BufferError:
+            pass
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                pass
+            self.mapping = None
@@ -0,0 +1,94 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Any, List, Optional
+import mkexec
+import progress
+
+PROGRESS = 'progress'
+READY = 'ready'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+@dataclass(slots=True)
+class LoadEvent:
+    kind: str
+    # scanning stage for PROGRESS, partial result name for READY
+    stage: str = ''
+    done: int = 0
+    total: int = 0
+    # partial result for READY, MkExec for DONE, error message for FAILED
+    value: Any = None
+
+
+class ExecLoader:
+    '''Loads MkExec on a worker thread. Progress, partial results and the
+    final MkExec are passed as LoadEvents through a thread safe queue, the
+    owner drains it with Events() (e.g. from a Tk after() callback).
+    '''
+    def __init__(self, file_name: str, jobs: Optional[int] = None) -> None:
+        self.file_name = file_name
+        self.jobs = jobs
+        self.events: 'queue.Queue[LoadEvent]' = queue.Queue()
+        self.progress = progress.Progress(
+            lambda stage, done, total: self.events.put(
+                LoadEvent(PROGRESS, stage, done, total)),
+            lambda stage, value: self.events.put(
+                LoadEvent(READY, stage, value=value)))
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    @property
+    def running(self) -> bool:
+        return self.thread.is_alive()
+
+    def Cancel(self) -> None:
+        self.progress.Cancel()
+
+    def Events(self) -> List[LoadEvent]:
+        '''Events posted since the last call, never blocks.'''
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def __run(self) -> None:
+        try:
+            mkobj = mkexec.MkExec(self.file_name,
+                                  jobs=self.jobs,
+                                  progress=self.progress)
+        except progress.Cancelled:
+            self.events.put(LoadEvent(CANCELLED))
+            return
+        except Exception as e:
+            self.events.put(LoadEvent(FAILED, value=str(e)))
+            return
+        if self.progress.cancelled:
+            mkobj.Close()
+            self.events.put(LoadEvent(CANCELLED))
+            return
+        self.events.put(LoadEvent(DONE, value=mkobj))
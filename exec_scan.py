@@ -0,0 +1,153 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from typing import Dict, List, Optional
+import numpy as np
+import mktypes
+
+PALETTE_MIN_COLORS = 2
+PALETTE_MAX_COLORS = 256
+
+
+def AsBytes(buffer: memoryview) -> np.ndarray:
+    return np.frombuffer(buffer, dtype=np.uint8)
+
+
+def UnalignedU16(b: np.ndarray) -> np.ndarray:
+    '''Little endian WORD starting at every byte offset of the buffer.'''
+    if len(b) < 2:
+        return np.zeros(0, dtype=np.uint16)
+    return b[:-1].astype(np.uint16) | (b[1:].astype(np.uint16) << 8)
+
+
+def GatherU32(b: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    '''Little endian DWORDs starting at the given byte offsets.'''
+    return (b[positions].astype(np.uint32)
+            | (b[positions + 1].astype(np.uint32) << 8)
+            | (b[positions + 2].astype(np.uint32) << 16)
+            | (b[positions + 3].astype(np.uint32) << 24))
+
+
+def PaletteCandidates(buffer: memoryview) -> np.ndarray:
+    '''Offsets that pass the cheap part of Palette.FromBytes checks: colors
+    count in range, palette fits in the buffer and no color has the top bit
+    set. Returned offsets are sorted.
+    '''
+    b = AsBytes(buffer)
+    n = len(b)
+    counts = UnalignedU16(b)
+    idx = np.flatnonzero((counts >= PALETTE_MIN_COLORS)
+                         & (counts <= PALETTE_MAX_COLORS))
+    ends = idx + 2 * counts[idx].astype(np.int64)
+    fits = ends + 2 <= n
+    idx = idx[fits]
+    ends = ends[fits]
+    if not len(idx):
+        return idx
+    # Prefix sums of "WORD at offset has the top bit set", computed separately
+    # for even and odd offsets, so bad colors in [pos + 2, pos + 2 * count]
+    # can be counted with a single subtraction.
+    high_bit = (b[1:] >= 0x80).astype(np.int32)
+    prefix = np.empty_like(high_bit)
+    prefix[0::2] = np.cumsum(high_bit[0::2])
+    prefix[1::2] = np.cumsum(high_bit[1::2])
+    return idx[prefix[ends] == prefix[idx]]
+
+
+def ValidPalettePositions(buffer: memoryview,
+                          limit: Optional[int] = None) -> np.ndarray:
+    '''Offsets below limit where Palette.FromBytes succeeds, overlapping
+    palettes included.
+    '''
+    pos = PaletteCandidates(buffer)
+    if limit is not None:
+        pos = pos[pos < limit]
+    valid = [
+        p for p in pos.tolist()
+        if mktypes.Palette.FromBytes(buffer, p) is not None
+    ]
+    return np.array(valid, dtype=np.int64)
+
+
+def AcceptPalettes(buffer: memoryview,
+                   valid_positions: np.ndarray) -> Dict[int, mktypes.Palette]:
+    '''Greedy walk of the byte by byte search over already validated
+    palette offsets: palettes overlapping an accepted one are skipped.
+    '''
+    palettes: Dict[int, mktypes.Palette] = dict()
+    next_pos = 0
+    for pos in valid_positions.tolist():
+        if pos < next_pos:
+            continue
+        palette = mktypes.Palette.FromBytes(buffer, pos)
+        assert palette is not None
+        palettes[pos] = palette
+        next_pos = pos + palette.on_disk_size
+    return palettes
+
+
+def FindPalettes(buffer: memoryview) -> Dict[int, mktypes.Palette]:
+    '''Vectorized equivalent of the byte by byte palette search: candidates
+    are prefiltered with array operations, the greedy walk (skipping over
+    already accepted palettes) and the remaining checks are applied only to
+    the survivors.
+    '''
+    palettes: Dict[int, mktypes.Palette] = dict()
+    next_pos = 0
+    for pos in PaletteCandidates(buffer).tolist():
+        if pos < next_pos:
+            continue
+        palette = mktypes.Palette.FromBytes(buffer, pos)
+        if not palette:
+            continue
+        palettes[pos] = palette
+        next_pos = pos + palette.on_disk_size
+    return palettes
+
+
+def FileSizeCandidates(buffer: memoryview,
+                       limit: Optional[int] = None) -> np.ndarray:
+    '''Offsets (below limit) of DWORDs that may be FileEntry.file_size, i.e.
+    they are followed by a valid partial FileEntry (see
+    FileEntry.isValidPartial). Returned offsets are sorted.
+    '''
+    b = AsBytes(buffer)
+    n = len(b)
+    last = n - mktypes.FileEntry.SIZE + 4
+    if limit is not None:
+        last = min(last, limit - 1)
+    if last < 0:
+        return np.zeros(0, dtype=np.int64)
+    pos = np.flatnonzero(b[4:last + 5] == 0x12)
+    for field in (4, 8, 12, 16):
+        pos = pos[GatherU32(b, pos + field) == (0x12 if field == 4 else 0)]
+    return pos
+
+
+def IndexBySize(buffer: memoryview,
+                size_candidates: np.ndarray) -> Dict[int, List[int]]:
+    '''Maps every potential FileEntry.file_size value (as returned by
+    FileSizeCandidates) to the offsets where it was found.
+    '''
+    pos = size_candidates
+    index: Dict[int, List[int]] = dict()
+    for size, p in zip(GatherU32(AsBytes(buffer), pos).tolist(), pos.tolist()):
+        index.setdefault(size, []).append(p)
+    return index
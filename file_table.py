@@ -0,0 +1,147 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import ntpath
+import re
+import numpy as np
+import mktypes
+import exec_scan
+
+
+@dataclass
+class FileTableEntry:
+    name: str
+    file_id: int
+    file_size: int
+    # position of the FileEntry record in the executable
+    position: int
+
+
+class FileTable:
+    '''The table of FileEntry records stored in the MK executable. File id of
+    a GRA file is the index of its FileEntry in this table.
+    '''
+    entries: List[FileTableEntry]
+    by_name: Dict[str, FileTableEntry]
+    # FileEntry.file_name_offset - image_base is the file offset of the name
+    image_base: int
+
+    # NUL terminated 'name.ext' strings
+    FILE_NAME_RE = re.compile(rb'[\x21-\x7e]{0,250}\.[0-9A-Za-z]{1,3}\x00')
+    MAX_FILE_NAME = 256
+
+    def __init__(self,
+                 entries: Optional[List[FileTableEntry]] = None,
+                 image_base: int = 0) -> None:
+        self.entries = entries if entries else []
+        self.image_base = image_base
+        self.by_name = dict()
+        for entry in self.entries:
+            self.by_name.setdefault(FileTable.Key(entry.name), entry)
+
+    @staticmethod
+    def Key(file_name: str) -> str:
+        return ntpath.basename(file_name.replace('/', '\\')).upper()
+
+    def Lookup(self, file_name: str,
+               file_size: int) -> Optional[FileTableEntry]:
+        entry = self.by_name.get(FileTable.Key(file_name))
+        if entry is None or entry.file_size != file_size:
+            return None
+        return entry
+
+    @staticmethod
+    def __findRuns(
+        buffer: memoryview, size_candidates: np.ndarray
+    ) -> List[List[Tuple[int, mktypes.FileEntry]]]:
+        '''Groups of valid FileEntry records that directly follow each other.
+        Each group is returned as a list of (position, FileEntry) pairs.
+        '''
+        runs: List[List[Tuple[int, mktypes.FileEntry]]] = []
+        last_pos = -1
+        for size_pos in size_candidates.tolist():
+            pos = size_pos - 4
+            if pos < 0:
+                continue
+            file_entry = mktypes.FileEntry.FromBytes(
+                buffer[pos:pos + mktypes.FileEntry.SIZE])
+            if not file_entry.isValid():
+                continue
+            if pos != last_pos + mktypes.FileEntry.SIZE:
+                runs.append([])
+            runs[-1].append((pos, file_entry))
+            last_pos = pos
+        return runs
+
+    @staticmethod
+    def __findImageBase(buffer: memoryview,
+                        pointers: List[int]) -> Optional[int]:
+        '''Every (pointer, file name string) pair votes for image_base =
+        pointer - string offset, the real image base collects a vote from
+        almost every file entry.
+        '''
+        starts = [m.start() for m in FileTable.FILE_NAME_RE.finditer(buffer)]
+        if not pointers or not starts:
+            return None
+        deltas = np.subtract.outer(np.array(pointers, dtype=np.int64),
+                                   np.array(starts, dtype=np.int64)).ravel()
+        values, counts = np.unique(deltas, return_counts=True)
+        return int(values[np.argmax(counts)])
+
+    @staticmethod
+    def __readName(buffer: memoryview, pos: int) -> Optional[str]:
+        if pos < 0 or pos >= len(buffer):
+            return None
+        name = bytes(buffer[pos:pos + FileTable.MAX_FILE_NAME])
+        end = name.find(b'\x00')
+        if end == -1 or not FileTable.FILE_NAME_RE.fullmatch(name[:end + 1]):
+            return None
+        return name[:end].decode('ascii')
+
+    @staticmethod
+    def FromBytes(buffer: memoryview,
+                  size_candidates: Optional[np.ndarray] = None) -> 'FileTable':
+        '''size_candidates are exec_scan.FileSizeCandidates(buffer), they
+        are computed when not given.
+        '''
+        if size_candidates is None:
+            size_candidates = exec_scan.FileSizeCandidates(buffer)
+        runs = FileTable.__findRuns(buffer, size_candidates)
+        if not runs:
+            return FileTable()
+        image_base = FileTable.__findImageBase(
+            buffer, [e.file_name_offset for r in runs for _, e in r])
+        if image_base is None:
+            return FileTable()
+        best: List[FileTableEntry] = []
+        for run in runs:
+            entries = []
+            for file_id, (pos, file_entry) in enumerate(run):
+                name = FileTable.__readName(
+                    buffer, file_entry.file_name_offset - image_base)
+                if name is not None:
+                    entries.append(
+                        FileTableEntry(name, file_id, file_entry.file_size,
+                                       pos))
+            if len(entries) > len(best):
+                best = entries
+        return FileTable(best, image_base)
@@ -18,24 +18,39 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-from typing import Dict, List
+from array import array
+from collections import Counter
+from dataclasses import dataclass
+from functools import cache
+from typing import Dict, List, Optional, Tuple
+import numpy as np
 import mktypes
 import mkexec
+import lru
+import data_source
+import profiling
 
 
-def GetNumberOfColors(buf):
-    return max(buf) - 1
+def GetNumberOfColors(buf: mktypes.PixelBuffer) -> int:
+    return max(buf.pixels) - 1
 
 
-def DecodePixels(data: memoryview,
-                 width: int,
-                 height: int,
-                 alpha_color: int = -1,
-                 palette_shift: int = 0) -> List[int]:
-    output = []
+@cache
+def ShiftTable(palette_shift: int) -> bytes:
+    return bytes((pixel + palette_shift) & 0xFF for pixel in range(256))
+
+
+def ParseRuns(data: memoryview, width: int,
+              height: int) -> Optional[mktypes.RunTable]:
+    '''First decoding phase: walks the RLE control words only and builds
+    the run table, returns None when the sprite doesn't decode cleanly.
+    '''
+    runs = mktypes.RunTable(array('B'), array('I'), array('I'))
+    size = width * height
     width_bak = width & 0xFF
 
     current_offset = 0
+    position = 0
     while height != 0 and current_offset + 4 <= len(data):
         code = mktypes.STRUCT_UINT_unpack(data[current_offset:current_offset +
                                                4])[0]
@@ -45,20 +60,27 @@ def DecodePixels(data: memoryview,
         bit1 = code & 1
         if bit0:
             if code > width * height:
-                return []
-            output.extend([alpha_color] * code)
+                return None
+            kind = mktypes.RunTable.TRANSPARENT
+            value = 0
         elif bit1:
             code >>= 1
-            pixel = code & 0xFF
+            kind = mktypes.RunTable.SOLID
+            value = code & 0xFF
             code >>= 8
-            output.extend([(pixel + palette_shift) & 0xFF] * code)
         else:
             code >>= 1
-            read_length = (code + 3) & 0xFFFFFFFC
-            data_read = data[current_offset:current_offset + code]
-            current_offset += read_length
-            output.extend([(pixel + palette_shift) & 0xFF
-                           for pixel in data_read])
+            if current_offset + code > len(data):
+                return None
+            kind = mktypes.RunTable.LITERAL
+            value = current_offset
+            current_offset += (code + 3) & 0xFFFFFFFC
+        position += code
+        if position > size:
+            return None
+        runs.kinds.append(kind)
+        runs.lengths.append(code)
+        runs.values.append(value)
 
         width -= code
         if width != 0:
@@ -67,33 +89,251 @@ def DecodePixels(data: memoryview,
         width = width_bak
         height -= 1
 
-    return output if height == 0 else []
+    return runs if height == 0 else None
+
+
+def LiteralPixels(runs: mktypes.RunTable,
+                  lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''Output positions of all literal pixels and their offsets in the
+    sprite data.
+    '''
+    literal = np.asarray(runs.kinds) == mktypes.RunTable.LITERAL
+    literal_lengths = lengths[literal]
+    run_starts = np.cumsum(lengths) - lengths
+    in_run = np.arange(int(literal_lengths.sum())) - np.repeat(
+        np.cumsum(literal_lengths) - literal_lengths, literal_lengths)
+    values = np.asarray(runs.values).astype(np.int64)
+    return (np.repeat(run_starts[literal], literal_lengths) + in_run,
+            np.repeat(values[literal], literal_lengths) + in_run)
+
+
+def GetRunsNumberOfColors(runs: mktypes.RunTable, data: memoryview) -> int:
+    '''Same as GetNumberOfColors(DecodePixels(...)) without expanding the
+    sprite.
+    '''
+    kinds = np.asarray(runs.kinds)
+    values = np.asarray(runs.values)
+    max_index = 0
+    solid = (kinds == mktypes.RunTable.SOLID) & (np.asarray(runs.lengths) > 0)
+    if solid.any():
+        max_index = max(max_index, int(values[solid].max()))
+    _, src = LiteralPixels(runs, np.asarray(runs.lengths).astype(np.int64))
+    if len(src):
+        max_index = max(
+            max_index, int(np.frombuffer(data, dtype=np.uint8)[src].max()))
+    return max_index - 1
+
+
+def ExpandRuns(runs: mktypes.RunTable,
+               data: memoryview,
+               width: int,
+               height: int,
+               alpha_color: int = -1,
+               palette_shift: int = 0) -> mktypes.PixelBuffer:
+    '''Second decoding phase: expands the whole run table at once.'''
+    kinds = np.asarray(runs.kinds)
+    lengths = np.asarray(runs.lengths).astype(np.int64)
+    values = np.asarray(runs.values).astype(np.int64)
+    out = np.repeat(values.astype(np.uint8), lengths)
+    dst, src = LiteralPixels(runs, lengths)
+    if len(dst):
+        out[dst] = np.frombuffer(data, dtype=np.uint8)[src]
+    if palette_shift & 0xFF:
+        out = np.frombuffer(ShiftTable(palette_shift & 0xFF),
+                            dtype=np.uint8)[out]
+    output = mktypes.PixelBuffer(width, height, bytearray(width * height))
+    transparent = kinds == mktypes.RunTable.TRANSPARENT
+    if transparent.any():
+        mask = np.repeat(transparent, lengths)
+        out[mask] = alpha_color & 0xFF if alpha_color >= 0 else 0
+        output.alpha = bytearray(b'\xFF') * (width * height)
+        output.alpha[:len(mask)] = np.where(mask, 0, 0xFF).astype(
+            np.uint8).tobytes()
+    output.pixels[:len(out)] = out.tobytes()
+    return output
+
+
+def DecodePixels(data: memoryview,
+                 width: int,
+                 height: int,
+                 alpha_color: int = -1,
+                 palette_shift: int = 0) -> Optional[mktypes.PixelBuffer]:
+    '''Decodes RLE compressed sprite. Transparent pixels are marked in the
+    alpha mask, their palette index is alpha_color (or 0 when alpha_color is
+    negative).
+    '''
+    with profiling.Stage('DecodePixels', width * height):
+        runs = ParseRuns(data, width, height)
+        if runs is None:
+            return None
+        return ExpandRuns(runs, data, width, height, alpha_color,
+                          palette_shift)
+
+
+@dataclass(slots=True)
+class SelectionStats:
+    '''How much work GraFile saved while picking the file id candidate.'''
+    candidates: int = 0
+    candidates_pruned: int = 0
+    sprites_total: int = 0
+    sprites_validated: int = 0
+    sprites_skipped: int = 0
+
+
+# Number of sprites validated first for every file id candidate.
+SAMPLE_SIZE = 16
+
+# Default budget for decoded pixels kept by a lazy GraFile.
+DEFAULT_PIXEL_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def PixelBufferSize(buf: mktypes.PixelBuffer) -> int:
+    return len(buf.pixels) + (len(buf.alpha) if buf.alpha is not None else 0)
 
 
 class GraFile:
     sprites: Dict[int, mktypes.SpriteDescriptor]
 
-    def __init__(self, mkobj: mkexec.MkExec, file_name: str) -> None:
+    def __init__(self,
+                 mkobj: mkexec.MkExec,
+                 file_name: str,
+                 lazy: bool = True,
+                 cache_bytes: int = DEFAULT_PIXEL_CACHE_BYTES,
+                 gra_descriptor: Optional[mktypes.GraDescriptor] = None
+                 ) -> None:
+        '''In lazy mode sprites are only validated (RLE control words are
+        parsed), pixels are decoded on the first access to sprite.data and
+        kept in a LRU cache limited to cache_bytes. gra_descriptor skips the
+        file id lookup when it was already resolved (see MkExec.FindFileIds).
+        '''
         self.mkobj = mkobj
         self.sprites = dict()
+        self.lazy = lazy
+        self.pixel_cache = lru.ByteLru(cache_bytes, PixelBufferSize)
+        self.data = memoryview(b'')
+        self.source: Optional[data_source.DataSource] = None
         try:
-            with open(file_name, 'rb') as f:
-                self.data = memoryview(f.read())
+            self.source = data_source.DataSource(file_name)
         except:
             return
-        gra_descriptor = self.mkobj.FindFileId(file_name)
+        self.data = self.source.view
+        with profiling.Stage('GraFile', len(self.data)):
+            if gra_descriptor is None:
+                gra_descriptor = self.mkobj.FindFileId(file_name)
+            self.stats = SelectionStats()
+            self.sprites = self.__selectSprites(gra_descriptor)
+            for sprite in self.sprites.values():
+                assert sprite.runs is not None
+                if self.lazy:
+                    sprite.number_of_colors = GetRunsNumberOfColors(
+                        sprite.runs, self.data[sprite.offset:])
+                    sprite.source = self
+                else:
+                    sprite.data = self.DecodeSprite(sprite)
+                    sprite.number_of_colors = GetNumberOfColors(sprite.data)
+
+    def __validateCandidate(
+            self, sprites: List[mktypes.SpriteDescriptor],
+            to_beat: int) -> Optional[Dict[int, mktypes.SpriteDescriptor]]:
+        '''Parses run tables of candidate sprites, gives up as soon as the
+        number of distinct valid offsets can't exceed to_beat.
+        '''
+        # sprites left (untested or valid) for every offset
+        left = Counter(sprite.offset for sprite in sprites)
+        possible = len(left)
+        if possible <= to_beat:
+            self.stats.sprites_skipped += len(sprites)
+            return None
+        # Evenly spread sample goes first, so a bad candidate is rejected
+        # before most of its sprites are parsed.
+        step = max(1, len(sprites) // SAMPLE_SIZE)
+        sample = list(range(0, len(sprites), step))
+        sampled = set(sample)
+        order = sample + [i for i in range(len(sprites)) if i not in sampled]
+        for tested, index in enumerate(order, 1):
+            sprite = sprites[index]
+            sprite.runs = ParseRuns(self.data[sprite.offset:], sprite.width,
+                                    sprite.height)
+            if sprite.runs is not None:
+                continue
+            left[sprite.offset] -= 1
+            if left[sprite.offset] == 0:
+                possible -= 1
+                if possible <= to_beat:
+                    self.stats.sprites_validated += tested
+                    self.stats.sprites_skipped += len(sprites) - tested
+                    return None
+        self.stats.sprites_validated += len(sprites)
+        # Same order and same "last one wins" rule for duplicated offsets
+        # as decoding candidates one by one.
+        valid = dict()
+        for sprite in sprites:
+            if sprite.runs is not None:
+                valid[sprite.offset] = sprite
+        return valid
+
+    def __selectSprites(
+            self, gra_descriptor: mktypes.GraDescriptor
+    ) -> Dict[int, mktypes.SpriteDescriptor]:
+        '''Picks the file id candidate with the most valid sprites (the
+        first one on ties).
+        '''
+        candidates = []
         for id in gra_descriptor.file_ids:
             sprites = self.mkobj.GetSuitableSprites(id,
                                                     gra_descriptor.file_size)
-            if not sprites:
+            self.stats.candidates += 1
+            self.stats.sprites_total += len(sprites)
+            candidates.append(sprites)
+        # The most promising candidates go first to raise the bar early.
+        order = sorted(range(len(candidates)),
+                       key=lambda i: -len(set(s.offset for s in candidates[i])))
+        best: Dict[int, mktypes.SpriteDescriptor] = dict()
+        best_index = -1
+        for index in order:
+            # an earlier candidate wins ties
+            to_beat = len(best) if index > best_index else len(best) - 1
+            valid = self.__validateCandidate(candidates[index], to_beat)
+            if valid is None:
+                self.stats.candidates_pruned += 1
                 continue
-            temp_sprites = dict()
-            for sprite in sprites:
-                buffer = DecodePixels(self.data[sprite.offset:], sprite.width,
-                                      sprite.height)
-                if len(buffer):
-                    sprite.data = buffer
-                    sprite.number_of_colors = GetNumberOfColors(buffer)
-                    temp_sprites[sprite.offset] = sprite
-            if len(temp_sprites) > len(self.sprites):
-                self.sprites = temp_sprites
+            best = valid
+            best_index = index
+        return best
+
+    def __enter__(self) -> 'GraFile':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.Close()
+
+    def Close(self) -> None:
+        '''Releases the GRA file. Sprites decoded lazily must not be accessed
+        after closing unless their pixels are still cached.
+        '''
+        self.data = memoryview(b'')
+        if self.source is not None:
+            self.source.Close()
+            self.source = None
+
+    def DecodeSprite(self,
+                     sprite: mktypes.SpriteDescriptor,
+                     alpha_color: int = -1,
+                     palette_shift: int = 0) -> mktypes.PixelBuffer:
+        '''Expands pixels of an already validated sprite using its cached
+        run table.
+        '''
+        assert sprite.runs is not None
+        # same stage as DecodePixels, only the run table parsing is skipped
+        with profiling.Stage('DecodePixels', sprite.width * sprite.height):
+            return ExpandRuns(sprite.runs, self.data[sprite.offset:],
+                              sprite.width, sprite.height, alpha_color,
+                              palette_shift)
+
+    def GetPixels(self,
+                  sprite: mktypes.SpriteDescriptor) -> mktypes.PixelBuffer:
+        pixels = self.pixel_cache.Get(sprite.offset)
+        if pixels is None:
+            pixels = self.DecodeSprite(sprite)
+            self.pixel_cache.Put(sprite.offset, pixels)
+        return pixels
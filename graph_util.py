@@ -19,55 +19,243 @@
 '''
 
 from functools import cache
-from typing import List
+from typing import Dict, List, Optional, Sequence, Tuple
 from PIL import Image
-import itertools
+import numpy as np
 import mktypes
 
 
-def AddBorders(data: List[int], width: int, height: int, left: int, right: int,
-               top: int, bottom: int, color: int) -> List[int]:
-    ret = []
-    for y in range(0, height):
-        ret += [color] * left + data[y * width:y * width +
-                                     width] + [color] * right
-    if top != 0:
-        ret = [color] * ((width + left + right) * top) + ret
-    if bottom != 0:
-        ret.extend([color] * ((width + left + right) * bottom))
+def FillFrame(frame: mktypes.PixelBuffer, color: int) -> None:
+    '''Clears the frame with color, negative color makes it transparent.'''
+    frame.pixels[:] = bytes((max(color, 0), )) * len(frame.pixels)
+    if frame.alpha is not None:
+        frame.alpha[:] = (b'\x00' if color < 0 else b'\xFF') * len(
+            frame.alpha)
+
+
+def Blit(frame: mktypes.PixelBuffer, data: mktypes.PixelBuffer, left: int,
+         top: int) -> None:
+    '''Copies data into the frame at (left, top), parts outside the frame
+    are clipped.
+    '''
+    x0 = max(0, -left)
+    x1 = min(data.width, frame.width - left)
+    y0 = max(0, -top)
+    y1 = min(data.height, frame.height - top)
+    if x1 <= x0 or y1 <= y0:
+        return
+    dst = (slice(y0 + top, y1 + top), slice(x0 + left, x1 + left))
+    src = (slice(y0, y1), slice(x0, x1))
+    frame_shape = (frame.height, frame.width)
+    data_shape = (data.height, data.width)
+    np.frombuffer(frame.pixels, dtype=np.uint8).reshape(frame_shape)[dst] = \
+        np.frombuffer(data.pixels, dtype=np.uint8).reshape(data_shape)[src]
+    if frame.alpha is None:
+        return
+    frame_alpha = np.frombuffer(frame.alpha,
+                                dtype=np.uint8).reshape(frame_shape)
+    if data.alpha is None:
+        frame_alpha[dst] = 0xFF
+    else:
+        frame_alpha[dst] = np.frombuffer(
+            data.alpha, dtype=np.uint8).reshape(data_shape)[src]
+
+
+def AddBorders(data: mktypes.PixelBuffer, width: int, height: int,
+               left: int, right: int, top: int, bottom: int,
+               color: int) -> mktypes.PixelBuffer:
+    '''Pads the image with color, negative color adds transparent borders.
+    Negative borders crop the image.
+    '''
+    new_width = max(width + left + right, 0)
+    new_height = max(height + top + bottom, 0)
+    size = new_width * new_height
+    ret = mktypes.PixelBuffer(new_width, new_height, bytearray(size))
+    if color < 0 or data.alpha is not None:
+        ret.alpha = bytearray(size)
+    FillFrame(ret, color)
+    Blit(ret, data, left, top)
     return ret
 
 
+def ClippingBoxOffset(sprite: mktypes.SpriteDescriptor,
+                      clipping_box: mktypes.ClippingBox) -> Tuple[int, int]:
+    return (clipping_box.x_adjust - sprite.x, clipping_box.y_adjust - sprite.y)
+
+
 def AddClippingBox(sprite: mktypes.SpriteDescriptor,
-                   clipping_box: mktypes.ClippingBox, color: int) -> List[int]:
-    left_border = clipping_box.x_adjust - sprite.x
+                   clipping_box: mktypes.ClippingBox,
+                   color: int) -> mktypes.PixelBuffer:
+    left_border, top_border = ClippingBoxOffset(sprite, clipping_box)
     right_border = clipping_box.width - sprite.width - left_border
-    top_border = clipping_box.y_adjust - sprite.y
     bottom_border = clipping_box.height - sprite.height - top_border
     return AddBorders(sprite.data, sprite.width, sprite.height, left_border,
                       right_border, top_border, bottom_border, color)
 
 
+class FrameCompositor:
+    '''Composes animation frames: every sprite is blitted at its offset
+    inside the clipping box into a preallocated frame buffer. Buffers are
+    reused by subsequent Compose calls, so frames must not be kept after
+    the next call.
+    '''
+    def __init__(self) -> None:
+        self.frames: List[mktypes.PixelBuffer] = []
+
+    def __allocate(self, width: int, height: int, count: int) -> None:
+        if self.frames and (self.frames[0].width, self.frames[0].height) != (
+                width, height):
+            self.frames = []
+        while len(self.frames) < count:
+            self.frames.append(
+                mktypes.PixelBuffer(width, height, bytearray(width * height),
+                                    bytearray(width * height)))
+
+    def Compose(self,
+                sprites: List[mktypes.SpriteDescriptor],
+                clipping_box: mktypes.ClippingBox,
+                color: int = -1) -> List[mktypes.PixelBuffer]:
+        '''One frame per sprite, background is color (transparent when
+        negative).
+        '''
+        self.__allocate(clipping_box.width, clipping_box.height, len(sprites))
+        frames = self.frames[:len(sprites)]
+        for frame, sprite in zip(frames, sprites):
+            FillFrame(frame, color)
+            Blit(frame, sprite.data, *ClippingBoxOffset(sprite, clipping_box))
+        return frames
+
+
 MULT = 255.0 / 63
 
+# Row of Rgb15Table used for palette entries past the palette end.
+PADDING_INDEX = 0x8000
+
 
 @cache
+def Rgb15Table() -> np.ndarray:
+    '''RGB values of all 15-bit colors, plus white at PADDING_INDEX.'''
+    v = np.arange(0x8000, dtype=np.int32)
+    table = np.full((0x8001, 3), 0xFF, dtype=np.uint8)
+    for i, component in enumerate(((v >> 9), (v >> 4), (v << 1))):
+        table[:0x8000, i] = np.round(((component & 0x3F) | 1) * MULT)
+    return table
+
+
 def Convert15to24bitRGB(v: int) -> mktypes.Color:
-    r = int(round((((v >> 9) & 0x3F) | 1) * MULT))
-    g = int(round((((v >> 4) & 0x3F) | 1) * MULT))
-    b = int(round((((v << 1) & 0x3F) | 1) * MULT))
-    return mktypes.Color(r, g, b)
+    return mktypes.Color(*Rgb15Table()[v].tolist())
+
+
+def PalettesToRgb(palettes: Sequence[Sequence[int]]) -> np.ndarray:
+    '''Converts many palettes at once, returns a (len(palettes), 256, 3)
+    matrix, entries past the palette end are white. A 256 colors palette
+    has 257 entries (with the black one inserted), the last one can't be
+    indexed by pixels and is dropped.
+    '''
+    indices = np.full((len(palettes), 256), PADDING_INDEX, dtype=np.uint16)
+    if palettes:
+        palettes = [colors[:256] for colors in palettes]
+        counts = np.array([len(colors) for colors in palettes])
+        indices[np.arange(256) < counts[:, None]] = np.concatenate(
+            [np.asarray(colors, dtype=np.uint16) for colors in palettes])
+    return Rgb15Table()[indices]
+
+
+def PreparePalette(input_pal: Sequence[int]) -> List[mktypes.Color]:
+    return [mktypes.Color(*c) for c in PalettesToRgb([input_pal])[0].tolist()]
+
+
+# Transparent pixels are drawn with the canvas background color.
+TRANSPARENT_COLOR = mktypes.Color(0xFF, 0xFF, 0xFF)
+
+
+class PaletteLut:
+    '''Palette converted once to a 768 bytes RGB table (256 colors padded
+    like PreparePalette does) and per channel translation tables.
+    '''
+    def __init__(self,
+                 palette: mktypes.Palette,
+                 transparent: mktypes.Color = TRANSPARENT_COLOR,
+                 rgb: Optional[bytes] = None) -> None:
+        self.colors = palette.colors
+        if rgb is None:
+            rgb = PalettesToRgb([palette.colors])[0].tobytes()
+        self.rgb = rgb
+        self.channels = (self.rgb[0::3], self.rgb[1::3], self.rgb[2::3])
+        self.transparent = transparent
 
+    def Apply(self, buffer: mktypes.PixelBuffer) -> bytes:
+        '''Packed RGB pixels, transparent ones get the transparent color.'''
+        out = np.empty((len(buffer.pixels), 3), dtype=np.uint8)
+        alpha = None
+        if buffer.alpha is not None:
+            alpha = np.frombuffer(buffer.alpha, dtype=np.uint8)
+        for i, table in enumerate(self.channels):
+            channel = np.frombuffer(buffer.pixels.translate(table),
+                                    dtype=np.uint8)
+            if alpha is None:
+                out[:, i] = channel
+                continue
+            # alpha is either 0 or 0xFF, so it works as a bit mask
+            key = self.transparent.tuple()[i]
+            out[:, i] = (channel & alpha) | (key & ~alpha)
+        return out.tobytes()
 
-def PreparePalette(input_pal: List[int]) -> List[mktypes.Color]:
-    palette = [Convert15to24bitRGB(v) for v in input_pal]
-    palette.extend([mktypes.Color(0xFF, 0xFF, 0xFF)] * (256 - len(input_pal)))
-    return palette
+    def Rgb(self, transparent_index: Optional[int] = None) -> bytes:
+        '''RGB table, transparent_index entry replaced by the transparent
+        color.
+        '''
+        if transparent_index is None:
+            return self.rgb
+        pos = transparent_index * 3
+        return (self.rgb[:pos] + bytes(self.transparent.tuple()) +
+                self.rgb[pos + 3:])
 
 
-def ApplyPalette(buffer: List[int], palette: List[mktypes.Color]) -> bytes:
-    return bytes(
-        itertools.chain.from_iterable([palette[c].tuple() for c in buffer]))
+# palette offset -> LUT
+_palette_luts: Dict[int, PaletteLut] = dict()
+
+
+def GetPaletteLut(palette: mktypes.Palette) -> PaletteLut:
+    lut = _palette_luts.get(palette.offset)
+    if lut is None or (lut.colors is not palette.colors
+                       and lut.colors != palette.colors):
+        lut = PaletteLut(palette)
+        _palette_luts[palette.offset] = lut
+    return lut
+
+
+class PaletteMatrix:
+    '''All palettes of the executable converted to RGB in one go, rows are
+    indexed by palette offset.
+    '''
+    def __init__(self, palettes: Dict[int, mktypes.Palette]) -> None:
+        self.rows = {offset: row for row, offset in enumerate(palettes)}
+        self.rgb = PalettesToRgb([p.colors for p in palettes.values()])
+        self.luts: Dict[int, PaletteLut] = dict()
+
+    def Rgb(self, palette: mktypes.Palette) -> bytes:
+        '''768 bytes RGB table, palettes from elsewhere are converted on
+        the fly.
+        '''
+        row = self.rows.get(palette.offset)
+        if row is None:
+            return PalettesToRgb([palette.colors])[0].tobytes()
+        return self.rgb[row].tobytes()
+
+    def Lut(self, palette: mktypes.Palette) -> PaletteLut:
+        if palette.offset not in self.rows:
+            return GetPaletteLut(palette)
+        lut = self.luts.get(palette.offset)
+        if lut is None:
+            lut = PaletteLut(palette, rgb=self.Rgb(palette))
+            self.luts[palette.offset] = lut
+        return lut
+
+
+def ApplyPalette(buffer: mktypes.PixelBuffer,
+                 palette: mktypes.Palette) -> bytes:
+    return GetPaletteLut(palette).Apply(buffer)
 
 
 def CalculateClippingBox(
@@ -83,6 +271,80 @@ def CalculateClippingBox(
     return mktypes.ClippingBox(x_adjust, y_adjust, width, height)
 
 
+def ScaleImage(img: Image.Image, scale: float) -> Image.Image:
+    '''Integer scales use nearest neighbour, which is both faster and keeps
+    pixels sharp.
+    '''
+    size = (round(img.width * scale), round(img.height * scale))
+    if size == img.size:
+        return img
+    if scale == int(scale):
+        return img.resize(size, Image.Resampling.NEAREST)
+    return img.resize(size)
+
+
+def FreeIndex(buffers: List[mktypes.PixelBuffer]) -> Optional[int]:
+    '''Highest palette index not used by opaque pixels of the buffers.'''
+    used = np.zeros(256, dtype=bool)
+    for buf in buffers:
+        pixels = np.frombuffer(buf.pixels, dtype=np.uint8)
+        if buf.alpha is not None:
+            pixels = pixels[np.frombuffer(buf.alpha, dtype=np.uint8) != 0]
+        used[pixels] = True
+    free = np.flatnonzero(~used)
+    return int(free[-1]) if len(free) else None
+
+
+def IndexedPixels(buf: mktypes.PixelBuffer,
+                  transparent_index: Optional[int]) -> bytes:
+    '''Palette indices with transparent pixels set to transparent_index.'''
+    if buf.alpha is None or transparent_index is None:
+        return bytes(buf.pixels)
+    return np.where(np.frombuffer(buf.alpha, dtype=np.uint8),
+                    np.frombuffer(buf.pixels, dtype=np.uint8),
+                    transparent_index).astype(np.uint8).tobytes()
+
+
+class IndexedImage:
+    '''"P" mode image built once (and scaled) from the palette indices of a
+    pixel buffer, colorizing it only replaces the image palette.
+    Transparent pixels use an index no opaque pixel uses; buffers using all
+    256 indices are rare, those are colorized to RGB from the kept buffer.
+    '''
+    def __init__(self, buf: mktypes.PixelBuffer, scale: float = 1.0) -> None:
+        self.transparent_index = FreeIndex([buf])
+        self.scale = scale
+        # only kept when the indexed image can't represent transparency
+        self.buf: Optional[mktypes.PixelBuffer] = None
+        if buf.alpha is not None and self.transparent_index is None:
+            self.buf = buf
+        self.image = ScaleImage(
+            Image.frombytes('P', (buf.width, buf.height),
+                            IndexedPixels(buf, self.transparent_index)),
+            scale)
+
+    def __len__(self) -> int:
+        return self.image.width * self.image.height
+
+    def Colorize(self, lut: PaletteLut) -> Image.Image:
+        '''The image with lut colors, valid until the next call.'''
+        if self.buf is not None:
+            return ScaleImage(
+                Image.frombuffer('RGB', (self.buf.width, self.buf.height),
+                                 lut.Apply(self.buf), 'raw', 'RGB', 0, 1),
+                self.scale)
+        self.image.putpalette(lut.Rgb(self.transparent_index))
+        return self.image
+
+
+def GetSpriteImage(sprite: mktypes.SpriteDescriptor,
+                   palette: mktypes.Palette,
+                   lut: Optional[PaletteLut] = None) -> Image.Image:
+    if lut is None:
+        lut = GetPaletteLut(palette)
+    return IndexedImage(sprite.data).Colorize(lut)
+
+
 def GetSpritesImage(sprites: List[mktypes.SpriteDescriptor],
                     palette: mktypes.Palette,
                     max_width: int = 1024) -> Image.Image:
@@ -108,11 +370,7 @@ def GetSpritesImage(sprites: List[mktypes.SpriteDescriptor],
         if current_x + sprite.width > max_width:
             current_x = 0
             current_y += max_height
-        colored_sprite = ApplyPalette(sprite.data,
-                                      PreparePalette(palette.colors))
-        img = Image.frombuffer('RGB', (sprite.width, sprite.height),
-                               colored_sprite, 'raw', 'RGB', 0, 1)
-        ret.paste(img, box=(current_x, current_y))
+        ret.paste(GetSpriteImage(sprite, palette), box=(current_x, current_y))
         current_x += sprite.width
         if sprite.height > max_height:
             max_height = sprite.height
@@ -0,0 +1,72 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class ByteLru(Generic[T]):
+    '''Least recently used cache bounded by the total size (in bytes) of the
+    stored values. Values bigger than the whole budget are not stored.
+    '''
+    def __init__(self, max_bytes: int, sizeof: Callable[[T], int]) -> None:
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.items: 'OrderedDict[Hashable, T]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.items
+
+    def Get(self, key: Hashable) -> Optional[T]:
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return value
+
+    def Put(self, key: Hashable, value: T) -> None:
+        self.Remove(key)
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        self.items[key] = value
+        self.used_bytes += size
+        while self.used_bytes > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.used_bytes -= self.sizeof(evicted)
+
+    def Remove(self, key: Hashable) -> None:
+        value = self.items.pop(key, None)
+        if value is not None:
+            self.used_bytes -= self.sizeof(value)
+
+    def Clear(self) -> None:
+        self.items.clear()
+        self.used_bytes = 0
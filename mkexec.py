@@ -19,87 +19,207 @@
 '''
 
 import os
-from typing import List, Dict
+from typing import List, Dict, Optional
 import mktypes
-from collections import defaultdict
+import exec_scan
+import sprite_table
+import file_table
+import scan_cache
+import parallel_scan
+import data_source
+import progress
+import profiling
+
+# Partial results reported through Progress.Ready while scanning.
+READY_PALETTES = 'palettes'
+READY_SPRITES = 'sprites'
+READY_FILE_TABLE = 'file_table'
 
 
 class MkExec:
-    # sprite_files: Dict[int, mktypes.SpriteFile]
-    sprite_files: Dict[int, List[mktypes.SpriteDescriptor]]
+    sprite_table: sprite_table.SpriteTable
+    file_table: file_table.FileTable
     palettes: Dict[int, mktypes.Palette]
+    # file size -> offsets of FileEntry.file_size candidates, built on demand
+    size_index: Optional[Dict[int, List[int]]]
+    # file size -> resolved file ids
+    file_ids: Dict[int, List[int]]
 
-    def __init__(self, mkexe_file_name: str) -> None:
+    def __init__(self,
+                 mkexe_file_name: str,
+                 use_cache: bool = True,
+                 jobs: Optional[int] = None,
+                 scan_results: Optional[scan_cache.ScanResults] = None,
+                 progress: Optional[progress.Progress] = None) -> None:
+        '''jobs limits the number of scanning processes, all CPUs are used by
+        default. Scanning is skipped when scan_results (see GetScanResults)
+        are given. Scanning stages report into progress, progress.Cancelled
+        is raised when it gets cancelled.
+        '''
         self.palettes = dict()
-        self.sprite_files = defaultdict(list)
+        self.sprite_table = sprite_table.SpriteTable.Empty()
+        self.file_table = file_table.FileTable()
+        self.size_index = None
+        self.file_ids = dict()
+        self.cache_key = ''
+        self.exec_data = memoryview(b'')
+        self.source: Optional[data_source.DataSource] = None
+        self.progress = progress
+        try:
+            self.source = data_source.DataSource(mkexe_file_name)
+        except:
+            return
+        self.exec_data = self.source.view
         try:
-            with open(mkexe_file_name, 'rb') as f:
-                self.exec_data = memoryview(f.read())
+            self.__scan(mkexe_file_name, use_cache, jobs, scan_results)
         except:
+            self.Close()
+            raise
+        finally:
+            self.progress = None
+
+    def __scan(self, mkexe_file_name: str, use_cache: bool,
+               jobs: Optional[int],
+               scan_results: Optional[scan_cache.ScanResults]) -> None:
+        if scan_results is not None:
+            self.__setScanResults(scan_results)
+            return
+        if use_cache and self.__loadFromCache():
             return
-        self.__paletteBruteForce()
-        self.__spriteBruteForce()
+        stage = profiling.Stage('MkExec', len(self.exec_data))
+        with stage, parallel_scan.ShardedScanner(self.exec_data, jobs,
+                                                 mkexe_file_name,
+                                                 self.progress) as scanner:
+            self.__paletteBruteForce(scanner)
+            self.__ready(READY_PALETTES, self.palettes)
+            self.__spriteBruteForce(scanner)
+            self.__ready(READY_SPRITES, self.sprite_table)
+            self.__fileTableSearch(scanner)
+            self.__ready(READY_FILE_TABLE, self.file_table)
+        if use_cache:
+            scan_cache.Store(self.cache_key, self.GetScanResults())
+
+    def __ready(self, stage: str, value) -> None:
+        if self.progress is not None:
+            self.progress.Ready(stage, value)
+
+    def __enter__(self) -> 'MkExec':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.Close()
+
+    def Close(self) -> None:
+        '''Releases the executable, scan results stay available but file ids
+        of GRA files missing from the file table can't be resolved anymore.
+        '''
+        self.exec_data = memoryview(b'')
+        if self.source is not None:
+            self.source.Close()
+            self.source = None
+
+    def __loadFromCache(self) -> bool:
+        self.cache_key = scan_cache.CacheKey(self.exec_data)
+        results = scan_cache.Load(self.cache_key)
+        if results is None:
+            return False
+        self.__setScanResults(results)
+        return True
+
+    def __setScanResults(self, results: scan_cache.ScanResults) -> None:
+        self.palettes = results.palettes
+        self.__ready(READY_PALETTES, self.palettes)
+        self.sprite_table = results.sprite_table
+        self.__ready(READY_SPRITES, self.sprite_table)
+        self.file_table = results.file_table
+        self.__ready(READY_FILE_TABLE, self.file_table)
 
-    def __paletteBruteForce(self) -> None:
+    def GetScanResults(self) -> scan_cache.ScanResults:
+        return scan_cache.ScanResults(self.palettes, self.sprite_table,
+                                      self.file_table)
+
+    def __paletteBruteForce(self,
+                            scanner: parallel_scan.ShardedScanner) -> None:
         if not self.exec_data:
             return
         # generic palette search
-        pos = 0
-        while pos < len(self.exec_data):
-            palette = mktypes.Palette.FromBytes(self.exec_data, pos)
-            if not palette:
-                pos += 1
-                continue
-            self.palettes[pos] = palette
-            pos += palette.on_disk_size
+        with profiling.Stage('paletteBruteForce', len(self.exec_data)):
+            self.palettes = scanner.Palettes()
 
-    def __spriteBruteForce(self) -> None:
+    def __spriteBruteForce(self,
+                           scanner: parallel_scan.ShardedScanner) -> None:
         # Generic sprite descriptor search.
-        pos = 0
-        while pos < len(self.exec_data):
-            potential_sprites = mktypes.SpriteDescriptor.FromBytes(
-                self.exec_data[pos:pos + mktypes.SpriteDescriptor.SIZE])
-            for s in potential_sprites:
-                self.sprite_files[s.file_id].append(s)
-            pos += 1
+        with profiling.Stage('spriteBruteForce', len(self.exec_data)):
+            self.sprite_table = scanner.SpriteTable()
 
-    def FindFileId(self, file_name: str) -> mktypes.GraDescriptor:
-        if not self.exec_data:
-            return mktypes.GraDescriptor(0, [])
-        try:
-            file_size = os.path.getsize(file_name)
-        except:
-            return mktypes.GraDescriptor(0, [])
+    def __fileTableSearch(self, scanner: parallel_scan.ShardedScanner) -> None:
+        with profiling.Stage('fileTableSearch', len(self.exec_data)):
+            size_candidates = scanner.FileSizeCandidates()
+            self.file_table = file_table.FileTable.FromBytes(
+                self.exec_data, size_candidates)
+            self.size_index = exec_scan.IndexBySize(self.exec_data,
+                                                    size_candidates)
 
+    def __fileIdAt(self, pos: int) -> Optional[int]:
+        '''Number of valid FileEntry records preceding the one whose
+        file_size field is at pos.
+        '''
+        file_id = 0
+        file_table_pos = pos - 4 - mktypes.FileEntry.SIZE
+        while file_table_pos >= 0:
+            file_entry = mktypes.FileEntry.FromBytes(
+                self.exec_data[file_table_pos:file_table_pos +
+                               mktypes.FileEntry.SIZE])
+            if not file_entry.isValid():
+                return file_id
+            file_id += 1
+            file_table_pos -= mktypes.FileEntry.SIZE
+        return None
+
+    def __fileIdsForSize(self, file_size: int) -> List[int]:
+        if file_size not in self.file_ids:
+            if self.size_index is None:
+                self.size_index = exec_scan.IndexBySize(
+                    self.exec_data,
+                    exec_scan.FileSizeCandidates(self.exec_data))
+            ids = []
+            for pos in self.size_index.get(file_size, []):
+                file_id = self.__fileIdAt(pos)
+                if file_id is not None:
+                    ids.append(file_id)
+            self.file_ids[file_size] = ids
+        return self.file_ids[file_size]
+
+    @profiling.Profiled('FindFileIds')
+    def FindFileIds(self,
+                    file_names: List[str]) -> List[mktypes.GraDescriptor]:
+        '''Resolves many GRA files at once. Files listed in the FileEntry
+        table are resolved by name, for the remaining ones the executable is
+        scanned for the file size only during the first call, subsequent
+        lookups are dictionary accesses.
+        '''
         ret = []
-        pos = 0
-        while pos < len(self.exec_data) - 4:
-            # Look for the GRA file size in the MK executable.
-            dword_0 = mktypes.STRUCT_UINT_unpack(self.exec_data[pos:pos +
-                                                                4])[0]
-            if dword_0 != file_size:
-                pos += 1
+        for file_name in file_names:
+            try:
+                file_size = os.path.getsize(file_name)
+            except:
+                ret.append(mktypes.GraDescriptor(0, []))
+                continue
+            if not self.exec_data:
+                ret.append(mktypes.GraDescriptor(0, []))
                 continue
-            partial_file_entry = mktypes.FileEntry.FromBytesPartial(
-                self.exec_data[pos + 4:pos + mktypes.FileEntry.SIZE])
-            if not partial_file_entry.isValidPartial():
-                pos += 1
+            entry = self.file_table.Lookup(file_name, file_size)
+            if entry is not None:
+                ret.append(mktypes.GraDescriptor(file_size, [entry.file_id]))
                 continue
-            # GRA file size found, now look for the begining of the GRA files table.
-            file_id = 0
-            file_table_pos = pos - 4 - mktypes.FileEntry.SIZE
-            while file_table_pos >= 0:
-                file_entry = mktypes.FileEntry.FromBytes(
-                    self.exec_data[file_table_pos:file_table_pos +
-                                   mktypes.FileEntry.SIZE])
-                if file_entry.isValid():
-                    file_id += 1
-                    file_table_pos -= mktypes.FileEntry.SIZE
-                else:
-                    ret.append(file_id)
-                    break
-            pos += 1
-        return mktypes.GraDescriptor(file_size, ret)
+            # Not listed in the file table, guess file id by the file size.
+            ret.append(
+                mktypes.GraDescriptor(file_size,
+                                      list(self.__fileIdsForSize(file_size))))
+        return ret
+
+    def FindFileId(self, file_name: str) -> mktypes.GraDescriptor:
+        return self.FindFileIds([file_name])[0]
 
     def GetSuitablePalettes(self,
                             min_colors: int) -> Dict[int, mktypes.Palette]:
@@ -111,6 +231,4 @@ class MkExec:
 
     def GetSuitableSprites(self, file_id: int,
                            file_size: int) -> List[mktypes.SpriteDescriptor]:
-        if file_id not in self.sprite_files:
-            return []
-        return [s for s in self.sprite_files[file_id] if s.offset < file_size]
+        return self.sprite_table.GetSuitableSprites(file_id, file_size)
@@ -0,0 +1,323 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from PIL import Image
+import mktypes
+import mkexec
+import grafile
+import graph_util
+import atlas
+import scan_cache
+import profiling
+
+# Executable shared by all files exported in a worker process.
+_worker_mkexec: Optional[mkexec.MkExec] = None
+
+
+@dataclass(slots=True)
+class ExportTask:
+    gra_file_name: str
+    gra_descriptor: mktypes.GraDescriptor
+    sheet_file_name: str
+    sprites_dir: str
+    # palette offset in the executable, None picks the first suitable one
+    palette_offset: Optional[int] = None
+    trim: bool = True
+
+
+@dataclass(slots=True)
+class ExportResult:
+    gra_file_name: str
+    sprites: int = 0
+    error: str = ''
+
+
+def ExpandInputs(inputs: List[str]) -> List[str]:
+    '''GRA files from directories and glob patterns, without duplicates.'''
+    files: List[str] = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            files.extend(
+                os.path.join(pattern, name)
+                for name in sorted(os.listdir(pattern))
+                if name.upper().endswith('.GRA'))
+        else:
+            files.extend(sorted(glob.glob(pattern)))
+    seen = set()
+    ret = []
+    for file_name in files:
+        key = os.path.normcase(os.path.abspath(file_name))
+        if key not in seen and os.path.isfile(file_name):
+            seen.add(key)
+            ret.append(file_name)
+    return ret
+
+
+def OutputNames(gra_files: List[str]) -> List[str]:
+    '''Output paths (without extension) relative to the output directory.
+    Directories of the inputs are mirrored below their common root, so
+    files with the same name in different directories don't collide.
+    Raises ValueError when two inputs still map to the same output.
+    '''
+    dirs = [os.path.dirname(os.path.abspath(f)) for f in gra_files]
+    root = os.path.commonpath(dirs)
+    names = [
+        os.path.normpath(
+            os.path.join(os.path.relpath(d, root),
+                         os.path.splitext(os.path.basename(f))[0]))
+        for d, f in zip(dirs, gra_files)
+    ]
+    seen: Dict[str, str] = dict()
+    for name, gra_file_name in zip(names, gra_files):
+        key = os.path.normcase(name)
+        if key in seen:
+            raise ValueError('%s and %s would be exported to %s' %
+                             (seen[key], gra_file_name, name))
+        seen[key] = gra_file_name
+    return names
+
+
+def ExportOptions(task: ExportTask) -> dict:
+    '''Options changing the output, stored in the atlas sidecar.'''
+    return {'palette_offset': task.palette_offset, 'trim': task.trim}
+
+
+def IsUpToDate(task: ExportTask, exe_file_name: str) -> bool:
+    '''The sheet is written last, so it marks a complete export. Files
+    exported with other options are out of date.
+    '''
+    try:
+        sheet_mtime = os.path.getmtime(task.sheet_file_name)
+        if not (os.path.isdir(task.sprites_dir)
+                and sheet_mtime >= os.path.getmtime(task.gra_file_name)
+                and sheet_mtime >= os.path.getmtime(exe_file_name)):
+            return False
+        with open(atlas.SidecarFileName(task.sheet_file_name)) as f:
+            return json.load(f).get('options') == ExportOptions(task)
+    except (OSError, ValueError, AttributeError):
+        return False
+
+
+def SelectPalette(mkobj: mkexec.MkExec,
+                  sprites: List[mktypes.SpriteDescriptor],
+                  palette_offset: Optional[int]) -> Optional[mktypes.Palette]:
+    '''Same default as the viewer: the first palette with enough colors for
+    all sprites.
+    '''
+    if palette_offset is not None:
+        return mkobj.palettes.get(palette_offset)
+    min_colors = max((s.number_of_colors for s in sprites), default=0)
+    for palette in mkobj.GetSuitablePalettes(min_colors).values():
+        return palette
+    return None
+
+
+def SpriteImage(sprite: mktypes.SpriteDescriptor,
+                lut: graph_util.PaletteLut) -> Image.Image:
+    '''Like the atlas, transparent pixels stay transparent: through the
+    palette transparency, or an alpha channel for sprites using all 256
+    palette indices.
+    '''
+    buf = sprite.data
+    indexed = graph_util.IndexedImage(buf)
+    image = indexed.Colorize(lut)
+    if buf.alpha is None:
+        return image
+    if indexed.transparent_index is not None:
+        image.info['transparency'] = indexed.transparent_index
+        return image
+    image = image.convert('RGBA')
+    image.putalpha(Image.frombytes('L', (buf.width, buf.height),
+                                   bytes(buf.alpha)))
+    return image
+
+
+def SaveImage(img, file_name: str) -> None:
+    '''Writes through a temporary file, so an interrupted export never leaves
+    a truncated image behind.
+    '''
+    tmp_name = file_name + '.tmp'
+    img.save(tmp_name, format='PNG')
+    os.replace(tmp_name, file_name)
+
+
+def ExportFile(mkobj: mkexec.MkExec, task: ExportTask) -> ExportResult:
+    result = ExportResult(task.gra_file_name)
+    try:
+        with grafile.GraFile(mkobj,
+                             task.gra_file_name,
+                             gra_descriptor=task.gra_descriptor) as gra:
+            sprites = list(gra.sprites.values())
+            if not sprites:
+                result.error = 'no sprites found'
+                return result
+            palette = SelectPalette(mkobj, sprites, task.palette_offset)
+            if palette is None:
+                result.error = 'no suitable palette'
+                return result
+            os.makedirs(task.sprites_dir, exist_ok=True)
+            lut = graph_util.GetPaletteLut(palette)
+            for sprite in sprites:
+                SaveImage(
+                    SpriteImage(sprite, lut),
+                    os.path.join(task.sprites_dir,
+                                 '%06x.png' % sprite.offset))
+            sheet = atlas.BuildAtlas(sprites, palette, trim=task.trim)
+            atlas.SaveSidecar(sheet, task.sheet_file_name,
+                              ExportOptions(task))
+            SaveImage(sheet.image, task.sheet_file_name)
+            result.sprites = len(sprites)
+    except Exception as e:
+        result.error = str(e)
+    return result
+
+
+def _InitWorker(exe_file_name: str,
+                scan_results: scan_cache.ScanResults) -> None:
+    global _worker_mkexec
+    _worker_mkexec = mkexec.MkExec(exe_file_name, scan_results=scan_results)
+
+
+def _ExportInWorker(task: ExportTask) -> ExportResult:
+    assert _worker_mkexec is not None
+    return ExportFile(_worker_mkexec, task)
+
+
+def _RunTasks(mkobj: mkexec.MkExec, exe_file_name: str,
+              tasks: List[ExportTask], jobs: int):
+    '''Yields results in completion order. Workers get the scan results of
+    the parent, the executable is scanned only once.
+    '''
+    if jobs == 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield ExportFile(mkobj, task)
+        return
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_InitWorker,
+                             initargs=(exe_file_name,
+                                       mkobj.GetScanResults())) as executor:
+        futures = [executor.submit(_ExportInWorker, task) for task in tasks]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def Main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Exports sprites of Mortal Kombat GRA files to PNG.')
+    parser.add_argument('exe', help='Mortal Kombat executable')
+    parser.add_argument('inputs',
+                        nargs='+',
+                        help='GRA files, directories or glob patterns')
+    parser.add_argument('-o',
+                        '--output',
+                        default='export',
+                        help='output directory (default: %(default)s)')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='number of worker processes')
+    parser.add_argument('-p',
+                        '--palette',
+                        type=lambda v: int(v, 16),
+                        help='palette offset in the executable (hex)')
+    parser.add_argument('--no-trim',
+                        dest='trim',
+                        action='store_false',
+                        help="don't trim transparent borders in the atlas")
+    parser.add_argument('-f',
+                        '--force',
+                        action='store_true',
+                        help='export files that are up to date too')
+    parser.add_argument('--profile',
+                        metavar='FILE',
+                        help='write stage totals and a Chrome trace to FILE '
+                        '(stages run by worker processes are not included, '
+                        'use -j 1 to profile everything)')
+    args = parser.parse_args(argv)
+    if args.profile:
+        profiling.Enable(args.profile)
+
+    gra_files = ExpandInputs(args.inputs)
+    if not gra_files:
+        print('No GRA files found.', file=sys.stderr)
+        return 1
+    try:
+        output_names = OutputNames(gra_files)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    jobs = max(1, min(args.jobs, len(gra_files)))
+    with mkexec.MkExec(args.exe, jobs=args.jobs) as mkobj:
+        if not mkobj.exec_data:
+            print("Can't read %s." % args.exe, file=sys.stderr)
+            return 1
+        if args.palette is not None and args.palette not in mkobj.palettes:
+            print('No palette at %x.' % args.palette, file=sys.stderr)
+            return 1
+        tasks = []
+        skipped = 0
+        for gra_file_name, gra_descriptor, name in zip(
+                gra_files, mkobj.FindFileIds(gra_files), output_names):
+            task = ExportTask(gra_file_name, gra_descriptor,
+                              os.path.join(args.output, name + '.png'),
+                              os.path.join(args.output, name), args.palette,
+                              args.trim)
+            if not args.force and IsUpToDate(task, args.exe):
+                skipped += 1
+                continue
+            tasks.append(task)
+        print('%d GRA files, %d up to date, %d to export.' %
+              (len(gra_files), skipped, len(tasks)),
+              flush=True)
+        os.makedirs(args.output, exist_ok=True)
+
+        # file names with the mirrored directory, names alone may repeat
+        display_names = {
+            gra_file_name: os.path.normpath(
+                os.path.join(os.path.dirname(name),
+                             os.path.basename(gra_file_name)))
+            for gra_file_name, name in zip(gra_files, output_names)
+        }
+        failed = 0
+        for done, result in enumerate(
+                _RunTasks(mkobj, args.exe, tasks, jobs), 1):
+            name = display_names[result.gra_file_name]
+            if result.error:
+                failed += 1
+                print('[%d/%d] %s: %s' % (done, len(tasks), name, result.error),
+                      flush=True)
+            else:
+                print('[%d/%d] %s: %d sprites' %
+                      (done, len(tasks), name, result.sprites),
+                      flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -18,21 +18,22 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+from array import array
 from dataclasses import dataclass
-from typing import ClassVar, List, Tuple, Optional
+from typing import ClassVar, List, Protocol, Sequence, Tuple, Optional
 import struct
 
 STRUCT_USHORT_unpack = struct.Struct('<H').unpack
 STRUCT_UINT_unpack = struct.Struct('<I').unpack
 
 
-@dataclass
+@dataclass(slots=True)
 class GraDescriptor:
     file_size: int
     file_ids: List[int]
 
 
-@dataclass
+@dataclass(slots=True)
 class ClippingBox:
     x_adjust: int
     y_adjust: int
@@ -40,7 +41,7 @@ class ClippingBox:
     height: int
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Color:
     r: int
     g: int
@@ -50,18 +51,62 @@ class Color:
         return self.r, self.g, self.b
 
 
-@dataclass
+@dataclass(slots=True)
 class ImageSize:
     width: int
     height: int
 
 
-@dataclass
+@dataclass(slots=True)
+class PixelBuffer:
+    '''Decoded image: one palette index per pixel and a separate transparency
+    mask (0 - transparent, 0xFF - opaque), None when all pixels are opaque.
+    '''
+    width: int
+    height: int
+    pixels: bytearray
+    alpha: Optional[bytearray] = None
+
+    def __len__(self) -> int:
+        return len(self.pixels)
+
+    def ToList(self, alpha_color: int = -1) -> List[int]:
+        if self.alpha is None:
+            return list(self.pixels)
+        return [
+            p if a else alpha_color for p, a in zip(self.pixels, self.alpha)
+        ]
+
+
+@dataclass(slots=True)
+class RunTable:
+    '''Parsed RLE control words of a sprite. For every run: its kind, length
+    in pixels and the pixel value (SOLID) or the offset of the literal pixels
+    relative to the beginning of the sprite data (LITERAL).
+    '''
+    kinds: 'array[int]'
+    lengths: 'array[int]'
+    values: 'array[int]'
+
+    TRANSPARENT: ClassVar[int] = 0
+    SOLID: ClassVar[int] = 1
+    LITERAL: ClassVar[int] = 2
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+
+@dataclass(slots=True)
 class Palette:
-    colors: List[int]
+    # 16-bit colors, stored as array('H')
+    colors: Sequence[int]
     offset: int = 0
     on_disk_size: int = 0
 
+    def __post_init__(self) -> None:
+        if not isinstance(self.colors, array):
+            self.colors = array('H', self.colors)
+
     @staticmethod
     def FromBytes(buffer: memoryview, position: int) -> Optional['Palette']:
         ''' Palette as defined in original MK executable:
@@ -85,12 +130,12 @@ class Palette:
         if len(set(unpacked_colors)) < 2 * len(unpacked_colors) / 3:
             return None
         # insert black color as a first entry for all palettes
-        return Palette([0, ] + list(unpacked_colors),
-                       position,
-                       2 + 2*colors_count) # yapf: disable
+        colors = array('H', (0, ))
+        colors.extend(unpacked_colors)
+        return Palette(colors, position, 2 + 2 * colors_count)
 
 
-@dataclass
+@dataclass(slots=True)
 class FileEntry:
     '''This struct mimics the one stored in MK executables:
     struct FileEntry {
@@ -138,7 +183,12 @@ class FileEntry:
         return FileEntry(0, 0, *d)
 
 
-@dataclass
+class SpriteSource(Protocol):
+    def GetPixels(self, sprite: 'SpriteDescriptor') -> PixelBuffer:
+        ...
+
+
+@dataclass(slots=True)
 class SpriteDescriptor:
     '''Sprite decriptors found in original MK executable:
     struct SpriteEntry
@@ -162,8 +212,12 @@ class SpriteDescriptor:
     height: int
     x: int
     y: int
-    data: List[int]
+    # decoded pixels, use data to access them
+    pixels: Optional[PixelBuffer] = None
     number_of_colors: int = 0
+    runs: Optional[RunTable] = None
+    # decodes pixels on demand when they are not stored in the descriptor
+    source: Optional['SpriteSource'] = None
 
     MIN_SIZE: ClassVar[int] = 8
     SIZE: ClassVar[int] = 12
@@ -171,6 +225,21 @@ class SpriteDescriptor:
     MAX_HEIGHT: ClassVar[int] = 240
     STRUCT_SHORT_2_unpack = struct.Struct('<2h').unpack
 
+    @property
+    def data(self) -> PixelBuffer:
+        '''Decoded pixels, raises ValueError for a sprite that was never
+        decoded.
+        '''
+        if self.pixels is not None:
+            return self.pixels
+        if self.source is not None:
+            return self.source.GetPixels(self)
+        raise ValueError('sprite at %x is not decoded' % self.offset)
+
+    @data.setter
+    def data(self, pixels: PixelBuffer) -> None:
+        self.pixels = pixels
+
     @staticmethod
     def __getIdOffset(id_offset: int) -> Tuple[int, int]:
         return id_offset >> 24, id_offset & 0xFFFFFF
@@ -191,8 +260,8 @@ class SpriteDescriptor:
                 buffer) >= SpriteDescriptor.SIZE:
             id, offset = SpriteDescriptor.__getIdOffset(
                 STRUCT_UINT_unpack(buffer[8:12])[0])
-            ret.append(SpriteDescriptor(id, offset, w, h, x, y, []))
+            ret.append(SpriteDescriptor(id, offset, w, h, x, y))
         id, offset = SpriteDescriptor.__getIdOffset(
             STRUCT_UINT_unpack(buffer[4:8])[0])
-        ret.append(SpriteDescriptor(id, offset, w, h, 0, 0, []))
+        ret.append(SpriteDescriptor(id, offset, w, h, 0, 0))
         return ret
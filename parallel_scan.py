@@ -0,0 +1,180 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Optional, Tuple
+import os
+import numpy as np
+import mktypes
+import exec_scan
+import sprite_table
+import data_source
+import progress
+
+# Shards are extended by the size of the largest record (a 256 colors
+# palette), so every record starting inside a shard is seen in full.
+SCAN_OVERLAP = 2 + 2 * exec_scan.PALETTE_MAX_COLORS
+# Smaller executables are scanned in the current process.
+PARALLEL_MIN_SIZE = 4 * 1024 * 1024
+SHARDS_PER_JOB = 4
+
+PALETTES = 'palettes'
+SPRITES = 'sprites'
+FILE_SIZES = 'file_sizes'
+
+
+def ShardRanges(size: int, shards: int) -> List[Tuple[int, int]]:
+    shards = max(1, min(shards, size))
+    bounds = [size * i // shards for i in range(shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def ScanShard(buffer: memoryview, kind: str, start: int, end: int):
+    '''Scans records starting in [start, end), returned positions are
+    relative to the whole buffer.
+    '''
+    part = buffer[start:min(len(buffer), end + SCAN_OVERLAP)]
+    limit = end - start
+    if kind == PALETTES:
+        return exec_scan.ValidPalettePositions(part, limit) + start
+    if kind == SPRITES:
+        columns = sprite_table.SpriteTable.ScanColumns(part, limit)
+        return columns._replace(found_at=columns.found_at + start)
+    if kind == FILE_SIZES:
+        return exec_scan.FileSizeCandidates(part, limit) + start
+    raise ValueError(kind)
+
+
+def _ScanSharedShard(shm_name: str, size: int, kind: str, start: int,
+                     end: int):
+    shm = shared_memory.SharedMemory(shm_name)
+    try:
+        assert shm.buf is not None
+        buffer = shm.buf[:size]
+        try:
+            return ScanShard(buffer, kind, start, end)
+        finally:
+            buffer.release()
+    finally:
+        shm.close()
+
+
+def _ScanFileShard(file_name: str, size: int, kind: str, start: int,
+                   end: int):
+    with data_source.DataSource(file_name) as source:
+        return ScanShard(source.view[:size], kind, start, end)
+
+
+class ShardedScanner:
+    '''Runs the executable scans on shards of the buffer in a process pool.
+    Workers map the executable file themselves when file_name is given (the
+    OS page cache is shared), otherwise the buffer is copied once to shared
+    memory. Merged results are identical to scanning the whole buffer at
+    once.
+    '''
+    def __init__(self,
+                 buffer: memoryview,
+                 jobs: Optional[int] = None,
+                 file_name: Optional[str] = None,
+                 progress: Optional[progress.Progress] = None) -> None:
+        self.buffer = buffer
+        self.file_name = file_name
+        self.progress = progress
+        self.jobs = jobs if jobs else (os.cpu_count() or 1)
+        if len(buffer) < PARALLEL_MIN_SIZE:
+            self.jobs = 1
+        self.shm: Optional[shared_memory.SharedMemory] = None
+        self.pool: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self) -> 'ShardedScanner':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.Close()
+
+    def Close(self) -> None:
+        if self.pool is not None:
+            # shards left after a cancellation are dropped
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __start(self) -> None:
+        if self.pool is not None:
+            return
+        if self.file_name is None:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=max(
+                                                      1, len(self.buffer)))
+            assert self.shm.buf is not None
+            self.shm.buf[:len(self.buffer)] = self.buffer
+        self.pool = ProcessPoolExecutor(self.jobs)
+
+    def __report(self, kind: str, done: int, total: int) -> None:
+        if self.progress is not None:
+            self.progress.Report(kind, done, total)
+
+    def Map(self, kind: str) -> list:
+        '''Per shard results in offset order, progress is reported after
+        every shard.
+        '''
+        if self.jobs == 1:
+            self.__report(kind, 0, 1)
+            results = [ScanShard(self.buffer, kind, 0, len(self.buffer))]
+            self.__report(kind, 1, 1)
+            return results
+        self.__start()
+        assert self.pool is not None
+        worker: Callable[[str, int, str, int, int], object]
+        if self.shm is not None:
+            worker, source = _ScanSharedShard, self.shm.name
+        else:
+            assert self.file_name is not None
+            worker, source = _ScanFileShard, self.file_name
+        ranges = ShardRanges(len(self.buffer), self.jobs * SHARDS_PER_JOB)
+        futures = [
+            self.pool.submit(worker, source, len(self.buffer), kind, start,
+                             end) for start, end in ranges
+        ]
+        self.__report(kind, 0, len(futures))
+        results = []
+        for future in futures:
+            results.append(future.result())
+            self.__report(kind, len(results), len(futures))
+        return results
+
+    def Palettes(self) -> Dict[int, mktypes.Palette]:
+        if self.jobs == 1:
+            self.__report(PALETTES, 0, 1)
+            palettes = exec_scan.FindPalettes(self.buffer)
+            self.__report(PALETTES, 1, 1)
+            return palettes
+        return exec_scan.AcceptPalettes(self.buffer,
+                                        np.concatenate(self.Map(PALETTES)))
+
+    def SpriteTable(self) -> sprite_table.SpriteTable:
+        return sprite_table.SpriteTable.FromColumns(self.Map(SPRITES))
+
+    def FileSizeCandidates(self) -> np.ndarray:
+        return np.concatenate(self.Map(FILE_SIZES))
@@ -0,0 +1,306 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import atexit
+import functools
+import json
+import multiprocessing
+import os
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set
+
+# Non-empty value enables profiling, any value other than '1' is also the
+# file written at exit.
+ENV_VAR = 'MKVIEWER_PROFILE'
+# Non-empty value other than '0' adds tracemalloc peaks (slows things down).
+MEMORY_ENV_VAR = 'MKVIEWER_PROFILE_MEMORY'
+# Trace events kept for the Chrome trace, stage totals are always complete.
+MAX_EVENTS = 200000
+
+
+@dataclass(slots=True)
+class StageStats:
+    calls: int = 0
+    seconds: float = 0.0
+    bytes: int = 0
+    # highest peak of a single call, bytes allocated above the call start
+    peak_memory: int = 0
+
+    def Add(self, other: 'StageStats') -> None:
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.bytes += other.bytes
+        self.peak_memory = max(self.peak_memory, other.peak_memory)
+
+    def ToJson(self) -> dict:
+        return {
+            'calls': self.calls,
+            'seconds': self.seconds,
+            'bytes': self.bytes,
+            'peak_memory': self.peak_memory
+        }
+
+
+def FormatBytes(size: int) -> str:
+    if size < 1024:
+        return '%d B' % size
+    if size < 1024 * 1024:
+        return '%.1f KiB' % (size / 1024)
+    return '%.1f MiB' % (size / (1024 * 1024))
+
+
+@dataclass(slots=True)
+class Operation:
+    '''Outermost stage of a thread together with all stages nested in it.'''
+    name: str
+    total: StageStats
+    stages: Dict[str, StageStats] = field(default_factory=dict)
+
+    def Summary(self, max_stages: int = 3) -> str:
+        text = '%s: %.1f ms' % (self.name, 1000 * self.total.seconds)
+        if self.total.bytes:
+            text += ', ' + FormatBytes(self.total.bytes)
+        if self.total.peak_memory:
+            text += ', peak ' + FormatBytes(self.total.peak_memory)
+        slowest = sorted(self.stages.items(), key=lambda s: -s[1].seconds)
+        for name, stats in slowest[:max_stages]:
+            text += ' | %s %.1f ms x%d' % (name, 1000 * stats.seconds,
+                                           stats.calls)
+        return text
+
+
+class Span:
+    '''One timed call of a stage, use as a context manager. Bytes can be
+    added while it runs when they are not known upfront.
+    '''
+    __slots__ = ('profiler', 'name', 'bytes', 'start', 'memory_start',
+                 'memory_peak', 'nested')
+
+    def __init__(self, profiler: 'Profiler', name: str, nbytes: int) -> None:
+        self.profiler = profiler
+        self.name = name
+        self.bytes = nbytes
+        self.start = 0.0
+        self.memory_start = 0
+        self.memory_peak = 0
+        self.nested: Dict[str, StageStats] = dict()
+
+    def Add(self, nbytes: int) -> None:
+        self.bytes += nbytes
+
+    def __enter__(self) -> 'Span':
+        self.profiler._Enter(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        end = time.perf_counter()
+        self.profiler._Exit(self, end)
+
+
+class NullSpan:
+    '''Returned while profiling is disabled.'''
+    __slots__ = ()
+
+    def Add(self, nbytes: int) -> None:
+        pass
+
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Profiler:
+    '''Collects per stage totals, trace events and the cost of the last
+    finished operation (of any thread). Nested stages are counted in their
+    own totals and in the totals of the enclosing ones.
+    '''
+    def __init__(self, memory: bool = False) -> None:
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+        self.stages: Dict[str, StageStats] = dict()
+        self.events: List[dict] = []
+        self.dropped_events = 0
+        self.last: Optional[Operation] = None
+        # spans measuring memory, they all share the tracemalloc peak
+        self.memory_spans: Set[Span] = set()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def Stage(self, name: str, nbytes: int = 0) -> Span:
+        return Span(self, name, nbytes)
+
+    def __stack(self) -> List[Span]:
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def __notePeak(self) -> int:
+        '''Moves the tracemalloc peak to all open spans, so it can be reset
+        for a nested one. Returns the current traced size.
+        '''
+        current, peak = tracemalloc.get_traced_memory()
+        for span in self.memory_spans:
+            span.memory_peak = max(span.memory_peak, peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def _Enter(self, span: Span) -> None:
+        self.__stack().append(span)
+        if self.memory:
+            with self.lock:
+                span.memory_start = span.memory_peak = self.__notePeak()
+                self.memory_spans.add(span)
+
+    def _Exit(self, span: Span, end: float) -> None:
+        stats = StageStats(1, end - span.start, span.bytes)
+        stack = self.__stack()
+        stack.pop()
+        with self.lock:
+            if self.memory:
+                self.__notePeak()
+                self.memory_spans.discard(span)
+                stats.peak_memory = span.memory_peak - span.memory_start
+            self.stages.setdefault(span.name, StageStats()).Add(stats)
+            if len(self.events) < MAX_EVENTS:
+                self.events.append({
+                    'name': span.name,
+                    'cat': 'mkviewer',
+                    'ph': 'X',
+                    'ts': 1e6 * (span.start - self.origin),
+                    'dur': 1e6 * stats.seconds,
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                    'args': {
+                        'bytes': span.bytes
+                    }
+                })
+            else:
+                self.dropped_events += 1
+            if not stack:
+                self.last = Operation(span.name, stats, span.nested)
+                return
+        nested = stack[-1].nested
+        nested.setdefault(span.name, StageStats()).Add(stats)
+        for name, child in span.nested.items():
+            nested.setdefault(name, StageStats()).Add(child)
+
+    def Summary(self) -> Dict[str, dict]:
+        with self.lock:
+            return {
+                name: stats.ToJson()
+                for name, stats in self.stages.items()
+            }
+
+    def Dump(self, file_name: str) -> None:
+        '''Stage totals and a Chrome trace (chrome://tracing, Perfetto) in
+        one JSON file.
+        '''
+        with self.lock:
+            events = list(self.events)
+            dropped = self.dropped_events
+        with open(file_name, 'w') as f:
+            json.dump(
+                {
+                    'stages': self.Summary(),
+                    'traceEvents': events,
+                    'droppedEvents': dropped,
+                    'displayTimeUnit': 'ms'
+                }, f)
+
+
+_profiler: Optional[Profiler] = None
+
+
+def Enable(output: Optional[str] = None, memory: bool = False) -> Profiler:
+    '''Starts collecting, output is written when the process exits.'''
+    global _profiler
+    _profiler = Profiler(memory)
+    if output:
+        atexit.register(_DumpAtExit, _profiler, output)
+    return _profiler
+
+
+def _DumpAtExit(profiler: Profiler, output: str) -> None:
+    # worker processes inherit the environment, only the main one writes
+    if multiprocessing.parent_process() is None:
+        profiler.Dump(output)
+
+
+def Disable() -> None:
+    global _profiler
+    _profiler = None
+
+
+def Active() -> Optional[Profiler]:
+    return _profiler
+
+
+def Stage(name: str, nbytes: int = 0):
+    '''Context manager timing one call of the stage, almost free while
+    profiling is disabled.
+    '''
+    profiler = _profiler
+    if profiler is None:
+        return NULL_SPAN
+    return profiler.Stage(name, nbytes)
+
+
+def Profiled(name: str, nbytes: Optional[Callable[..., int]] = None):
+    '''Decorator version of Stage, nbytes gets the arguments of the call.'''
+    def Decorator(function):
+        @functools.wraps(function)
+        def Wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return function(*args, **kwargs)
+            with profiler.Stage(name,
+                                nbytes(*args, **kwargs) if nbytes else 0):
+                return function(*args, **kwargs)
+
+        return Wrapper
+
+    return Decorator
+
+
+def LastOperation() -> Optional[Operation]:
+    profiler = _profiler
+    return profiler.last if profiler is not None else None
+
+
+def EnableFromEnvironment() -> None:
+    value = os.environ.get(ENV_VAR, '')
+    if value:
+        Enable(None if value == '1' else value,
+               os.environ.get(MEMORY_ENV_VAR, '') not in ('', '0'))
+
+
+EnableFromEnvironment()
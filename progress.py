@@ -0,0 +1,64 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import threading
+from typing import Any, Callable, Optional
+
+
+class Cancelled(Exception):
+    '''Raised from Progress methods after the operation was cancelled.'''
+
+
+class Progress:
+    '''Progress reporting and cancellation of long operations. Callbacks
+    are called on the thread doing the work, every report is also a
+    cancellation point.
+    '''
+    def __init__(
+            self,
+            on_progress: Optional[Callable[[str, int, int], None]] = None,
+            on_ready: Optional[Callable[[str, Any], None]] = None) -> None:
+        self.on_progress = on_progress
+        self.on_ready = on_ready
+        self.cancel_event = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def Cancel(self) -> None:
+        '''Thread safe, the work stops at the next cancellation point.'''
+        self.cancel_event.set()
+
+    def Check(self) -> None:
+        if self.cancel_event.is_set():
+            raise Cancelled()
+
+    def Report(self, stage: str, done: int, total: int) -> None:
+        '''done out of total units of stage are finished.'''
+        self.Check()
+        if self.on_progress is not None:
+            self.on_progress(stage, done, total)
+
+    def Ready(self, stage: str, value: Any) -> None:
+        '''Partial result of the operation is available.'''
+        self.Check()
+        if self.on_ready is not None:
+            self.on_ready(stage, value)
@@ -0,0 +1,102 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from PIL import ImageTk
+import mktypes
+import graph_util
+import lru
+
+# Default memory budget for rendered sprites.
+DEFAULT_RENDER_CACHE_BYTES = 96 * 1024 * 1024
+
+
+@dataclass(slots=True)
+class RenderedImage:
+    '''Indexed image and its PhotoImage, recoloring pastes the image with
+    the new palette into the same PhotoImage, so canvas items showing it
+    update too.
+    '''
+    indexed: graph_util.IndexedImage
+    photo: ImageTk.PhotoImage
+    lut: Optional[graph_util.PaletteLut] = None
+
+    @staticmethod
+    def Create(buf: mktypes.PixelBuffer, scale: float,
+               lut: graph_util.PaletteLut) -> 'RenderedImage':
+        indexed = graph_util.IndexedImage(buf, scale)
+        return RenderedImage(indexed, ImageTk.PhotoImage(indexed.Colorize(lut)),
+                             lut)
+
+    def SetPalette(self, lut: graph_util.PaletteLut) -> bool:
+        '''Returns False when the palette was already set.'''
+        if lut is self.lut:
+            return False
+        self.photo.paste(self.indexed.Colorize(lut))
+        self.lut = lut
+        return True
+
+
+def RenderedImageSize(image: RenderedImage) -> int:
+    # Tk keeps 32 bits per pixel, plus the indexed image
+    return 5 * len(image.indexed)
+
+
+class RenderCache:
+    '''Rendered sprite images keyed by (sprite offset, scale), bounded by
+    max_bytes. A palette change recolors cached images in place. Must be
+    cleared when another executable or GRA file is loaded, offsets are only
+    unique inside one file.
+    '''
+    def __init__(self, max_bytes: int = DEFAULT_RENDER_CACHE_BYTES) -> None:
+        self.images = lru.ByteLru(max_bytes, RenderedImageSize)
+        self.recolored = 0
+
+    @property
+    def hits(self) -> int:
+        return self.images.hits
+
+    @property
+    def misses(self) -> int:
+        return self.images.misses
+
+    @property
+    def used_bytes(self) -> int:
+        return self.images.used_bytes
+
+    @staticmethod
+    def Key(sprite: mktypes.SpriteDescriptor,
+            scale: float) -> Tuple[int, float]:
+        return sprite.offset, scale
+
+    def Get(self, sprite: mktypes.SpriteDescriptor, scale: float,
+            lut: graph_util.PaletteLut) -> ImageTk.PhotoImage:
+        key = RenderCache.Key(sprite, scale)
+        image = self.images.Get(key)
+        if image is None:
+            image = RenderedImage.Create(sprite.data, scale, lut)
+            self.images.Put(key, image)
+        elif image.SetPalette(lut):
+            self.recolored += 1
+        return image.photo
+
+    def Clear(self) -> None:
+        self.images.Clear()
@@ -0,0 +1,137 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from array import array
+from dataclasses import dataclass
+from typing import Dict, Optional
+import hashlib
+import os
+import tempfile
+import numpy as np
+import mktypes
+import sprite_table
+import file_table
+
+# Bump whenever the stored arrays or the scanning rules change.
+CACHE_VERSION = 1
+
+
+@dataclass
+class ScanResults:
+    palettes: Dict[int, mktypes.Palette]
+    sprite_table: sprite_table.SpriteTable
+    file_table: file_table.FileTable
+
+
+def CacheDir() -> str:
+    if 'MKVIEWER_CACHE_DIR' in os.environ:
+        return os.environ['MKVIEWER_CACHE_DIR']
+    if os.name == 'nt' and 'APPDATA' in os.environ:
+        config_dir = os.environ['APPDATA']
+    else:
+        config_dir = os.environ.get('XDG_CONFIG_HOME',
+                                    os.path.expanduser('~/.config'))
+    return os.path.join(config_dir, 'mkviewer', 'cache')
+
+
+def CacheKey(exec_data: memoryview) -> str:
+    return hashlib.blake2b(exec_data, digest_size=20).hexdigest()
+
+
+def CachePath(key: str) -> str:
+    return os.path.join(CacheDir(), key + '.npz')
+
+
+def Load(key: str) -> Optional[ScanResults]:
+    try:
+        with np.load(CachePath(key), allow_pickle=False) as f:
+            if int(f['version']) != CACHE_VERSION:
+                return None
+            palettes = dict()
+            colors = f['palette_colors']
+            start = 0
+            for offset, count in zip(f['palette_offsets'].tolist(),
+                                     f['palette_counts'].tolist()):
+                palettes[offset] = mktypes.Palette(
+                    array('H', colors[start:start + count].tobytes()),
+                    offset, 2 * count)
+                start += count
+            sprites = sprite_table.SpriteTable(f['sprite_width'],
+                                               f['sprite_height'],
+                                               f['sprite_x'], f['sprite_y'],
+                                               f['sprite_file_id'],
+                                               f['sprite_offset'])
+            names = str(f['file_names']).split('\n') if len(
+                f['file_ids']) else []
+            files = file_table.FileTable([
+                file_table.FileTableEntry(name, file_id, file_size, pos)
+                for name, file_id, file_size, pos in zip(
+                    names, f['file_ids'].tolist(), f['file_sizes'].tolist(),
+                    f['file_positions'].tolist())
+            ], int(f['image_base']))
+            return ScanResults(palettes, sprites, files)
+    except Exception:
+        # damaged or foreign files (e.g. zipfile.BadZipFile, EOFError) fall
+        # back to a full scan, like Store the cache is best effort
+        return None
+
+
+def Store(key: str, results: ScanResults) -> None:
+    '''Best effort, the cache is silently skipped when it can't be written.'''
+    palettes = list(results.palettes.values())
+    sprites = results.sprite_table
+    files = results.file_table.entries
+    try:
+        os.makedirs(CacheDir(), exist_ok=True)
+        fd, temp_name = tempfile.mkstemp(dir=CacheDir(), suffix='.tmp')
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(
+                f,
+                version=np.array(CACHE_VERSION),
+                # Palette.colors has the black color inserted at index 0
+                palette_offsets=np.array([p.offset for p in palettes],
+                                         dtype=np.int64),
+                palette_counts=np.array([len(p.colors) for p in palettes],
+                                        dtype=np.int64),
+                palette_colors=np.array(
+                    [c for p in palettes for c in p.colors], dtype=np.uint16),
+                sprite_width=sprites.width,
+                sprite_height=sprites.height,
+                sprite_x=sprites.x,
+                sprite_y=sprites.y,
+                sprite_file_id=sprites.file_id,
+                sprite_offset=sprites.offset,
+                image_base=np.array(results.file_table.image_base,
+                                    dtype=np.int64),
+                file_names=np.array('\n'.join(e.name for e in files)),
+                file_ids=np.array([e.file_id for e in files], dtype=np.int64),
+                file_sizes=np.array([e.file_size for e in files],
+                                    dtype=np.int64),
+                file_positions=np.array([e.position for e in files],
+                                        dtype=np.int64))
+        os.replace(temp_name, CachePath(key))
+    except OSError:
+        try:
+            os.remove(temp_name)
+        except OSError:
+            pass
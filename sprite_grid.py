@@ -0,0 +1,176 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bisect
+import tkinter as tk
+from typing import Callable, Dict, List, Optional, Tuple
+from PIL import ImageTk
+import mktypes
+
+SpriteRenderer = Callable[[mktypes.SpriteDescriptor], ImageTk.PhotoImage]
+
+
+def LayoutRows(sizes: List[mktypes.ImageSize],
+               width: int) -> List[Tuple[int, int]]:
+    '''Left to right row fill, returns (x, y) of every item.'''
+    positions = []
+    row_height = 0
+    current_x = 0
+    current_y = 0
+    for size in sizes:
+        if current_x + size.width > width and current_x:
+            current_x = 0
+            current_y += row_height
+            row_height = 0
+        positions.append((current_x, current_y))
+        current_x += size.width
+        row_height = max(row_height, size.height)
+    return positions
+
+
+class SpriteGridView:
+    '''Sprite grid on a scrollable canvas. The layout is computed once per
+    Show, images exist only for sprites intersecting the visible part of the
+    canvas (plus MARGIN pixels), sprites scrolled away are evicted.
+    '''
+    MARGIN = 256
+
+    def __init__(self, canvas: tk.Canvas, yscrollbar: tk.Scrollbar,
+                 xscrollbar: tk.Scrollbar) -> None:
+        self.canvas = canvas
+        self.yscrollbar = yscrollbar
+        self.xscrollbar = xscrollbar
+        self.canvas.configure(
+            yscrollcommand=lambda *args: self.__onScroll(yscrollbar, args),
+            xscrollcommand=lambda *args: self.__onScroll(xscrollbar, args))
+        yscrollbar.configure(command=self.canvas.yview)
+        xscrollbar.configure(command=self.canvas.xview)
+        self.canvas.bind('<Configure>', lambda e: self.__onResize())
+        self.canvas.bind('<MouseWheel>',
+                         lambda e: self.__scroll(-1 if e.delta > 0 else 1))
+        self.canvas.bind('<Button-4>', lambda e: self.__scroll(-1))
+        self.canvas.bind('<Button-5>', lambda e: self.__scroll(1))
+        self.sprites: List[mktypes.SpriteDescriptor] = []
+        self.sizes: List[mktypes.ImageSize] = []
+        self.positions: List[Tuple[int, int]] = []
+        # sorted tops of layout rows and index of their first sprite
+        self.row_tops: List[int] = []
+        self.row_starts: List[int] = []
+        self.layout_width = 0
+        self.render: Optional[SpriteRenderer] = None
+        # sprite index -> (canvas item, image)
+        self.visible: Dict[int, Tuple[int, ImageTk.PhotoImage]] = dict()
+
+    def Show(self, sprites: List[mktypes.SpriteDescriptor],
+             sizes: List[mktypes.ImageSize], render: SpriteRenderer) -> None:
+        '''sizes are the sizes of rendered sprites, render is called only
+        for sprites that become visible.
+        '''
+        self.Clear()
+        self.sprites = sprites
+        self.sizes = sizes
+        self.render = render
+        self.__layout()
+
+    def Clear(self) -> None:
+        for item, _ in self.visible.values():
+            self.canvas.delete(item)
+        self.visible = dict()
+        self.sprites = []
+        self.sizes = []
+        self.positions = []
+        self.row_tops = []
+        self.row_starts = []
+        self.render = None
+        self.canvas.configure(scrollregion=(0, 0, 0, 0))
+        self.canvas.xview_moveto(0)
+        self.canvas.yview_moveto(0)
+
+    def __layout(self) -> None:
+        self.layout_width = self.canvas.winfo_width()
+        self.positions = LayoutRows(self.sizes, self.layout_width)
+        self.row_tops = []
+        self.row_starts = []
+        width = 0
+        height = 0
+        for index, ((x, y), size) in enumerate(zip(self.positions,
+                                                   self.sizes)):
+            if not self.row_tops or self.row_tops[-1] != y:
+                self.row_tops.append(y)
+                self.row_starts.append(index)
+            width = max(width, x + size.width)
+            height = max(height, y + size.height)
+        for item, _ in self.visible.values():
+            self.canvas.delete(item)
+        self.visible = dict()
+        self.canvas.configure(scrollregion=(0, 0, width, height))
+        self.__update()
+
+    def __visibleRange(self, top: float, bottom: float) -> Tuple[int, int]:
+        '''Range of sprite indices of rows intersecting [top, bottom).'''
+        # the row above the first row starting below top may reach into it
+        first_row = max(0, bisect.bisect_right(self.row_tops, top) - 1)
+        last_row = bisect.bisect_left(self.row_tops, bottom)
+        end = (self.row_starts[last_row]
+               if last_row < len(self.row_starts) else len(self.sprites))
+        return self.row_starts[first_row] if self.row_starts else 0, end
+
+    def __update(self) -> None:
+        if self.render is None:
+            return
+        left = self.canvas.canvasx(0) - SpriteGridView.MARGIN
+        right = (self.canvas.canvasx(0) + self.canvas.winfo_width() +
+                 SpriteGridView.MARGIN)
+        top = self.canvas.canvasy(0) - SpriteGridView.MARGIN
+        bottom = (self.canvas.canvasy(0) + self.canvas.winfo_height() +
+                  SpriteGridView.MARGIN)
+        wanted = set()
+        start, end = self.__visibleRange(top, bottom)
+        for index in range(start, end):
+            x, y = self.positions[index]
+            size = self.sizes[index]
+            if (x < right and x + size.width > left and y < bottom
+                    and y + size.height > top):
+                wanted.add(index)
+        for index in list(self.visible):
+            if index not in wanted:
+                self.canvas.delete(self.visible.pop(index)[0])
+        for index in sorted(wanted):
+            if index in self.visible:
+                continue
+            image = self.render(self.sprites[index])
+            item = self.canvas.create_image(*self.positions[index],
+                                            image=image,
+                                            anchor=tk.NW)
+            self.visible[index] = (item, image)
+
+    def __onScroll(self, scrollbar: tk.Scrollbar, args) -> None:
+        scrollbar.set(*args)
+        self.__update()
+
+    def __onResize(self) -> None:
+        if self.render is not None and (self.canvas.winfo_width() !=
+                                        self.layout_width):
+            self.__layout()
+        else:
+            self.__update()
+
+    def __scroll(self, units: int) -> None:
+        self.canvas.yview_scroll(units, 'units')
@@ -0,0 +1,171 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from typing import List, NamedTuple, Optional
+import numpy as np
+import mktypes
+import exec_scan
+
+
+class SpriteColumns(NamedTuple):
+    '''Raw sprite descriptor scan results, see SpriteTable.ScanColumns.'''
+    found_at: np.ndarray
+    # 0 - SpriteEntry, 1 - SpriteEntryNoXY
+    variant: np.ndarray
+    width: np.ndarray
+    height: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    id_offset: np.ndarray
+
+    @staticmethod
+    def Empty() -> 'SpriteColumns':
+        return SpriteColumns(np.zeros(0, dtype=np.int64),
+                             np.zeros(0, dtype=np.int8),
+                             np.zeros(0, dtype=np.uint16),
+                             np.zeros(0, dtype=np.uint16),
+                             np.zeros(0, dtype=np.int16),
+                             np.zeros(0, dtype=np.int16),
+                             np.zeros(0, dtype=np.uint32))
+
+
+class SpriteTable:
+    '''Columnar storage of all sprite descriptor candidates found in the MK
+    executable. Rows are grouped by file_id, inside a group rows keep the
+    order in which they were found (by offset in the executable, SpriteEntry
+    before SpriteEntryNoXY for the same offset).
+    '''
+    width: np.ndarray
+    height: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    file_id: np.ndarray
+    offset: np.ndarray
+    # group_start[id]:group_start[id + 1] is the rows range for a given file_id
+    group_start: np.ndarray
+
+    MAX_FILE_ID = 0xFF
+    XY_RANGE = 256
+
+    def __init__(self, width: np.ndarray, height: np.ndarray, x: np.ndarray,
+                 y: np.ndarray, file_id: np.ndarray,
+                 offset: np.ndarray) -> None:
+        self.width = width
+        self.height = height
+        self.x = x
+        self.y = y
+        self.file_id = file_id
+        self.offset = offset
+        self.group_start = np.searchsorted(
+            file_id, np.arange(SpriteTable.MAX_FILE_ID + 2), side='left')
+
+    def __len__(self) -> int:
+        return len(self.file_id)
+
+    def HasFileId(self, file_id: int) -> bool:
+        if file_id < 0 or file_id > SpriteTable.MAX_FILE_ID:
+            return False
+        return self.group_start[file_id] != self.group_start[file_id + 1]
+
+    def GetSuitableSprites(self, file_id: int,
+                           file_size: int) -> List[mktypes.SpriteDescriptor]:
+        if not self.HasFileId(file_id):
+            return []
+        group = slice(self.group_start[file_id],
+                      self.group_start[file_id + 1])
+        rows = np.flatnonzero(self.offset[group] < file_size) + group.start
+        return [
+            mktypes.SpriteDescriptor(file_id, offset, w, h, x, y)
+            for offset, w, h, x, y in zip(
+                self.offset[rows].tolist(), self.width[rows].tolist(),
+                self.height[rows].tolist(), self.x[rows].tolist(),
+                self.y[rows].tolist())
+        ]
+
+    @staticmethod
+    def ScanColumns(buffer: memoryview,
+                    limit: Optional[int] = None) -> SpriteColumns:
+        '''Finds descriptors at offsets below limit (whole buffer by
+        default), rows are not sorted.
+        '''
+        b = exec_scan.AsBytes(buffer)
+        n = len(b)
+        min_size = mktypes.SpriteDescriptor.MIN_SIZE
+        if n < min_size:
+            return SpriteColumns.Empty()
+        words = exec_scan.UnalignedU16(b)
+        w = words[0:n - min_size + 1]
+        h = words[2:n - min_size + 3]
+        if limit is not None:
+            w = w[:limit]
+            h = h[:limit]
+        pos = np.flatnonzero((w != 0)
+                             & (w < mktypes.SpriteDescriptor.MAX_WIDTH)
+                             & (h != 0)
+                             & (h < mktypes.SpriteDescriptor.MAX_HEIGHT))
+        signed_words = words.view(np.int16)
+        x = signed_words[pos + 4]
+        y = signed_words[pos + 6]
+        with_xy = ((x >= -SpriteTable.XY_RANGE) & (x <= SpriteTable.XY_RANGE)
+                   & (y >= -SpriteTable.XY_RANGE) & (y <= SpriteTable.XY_RANGE)
+                   & (pos + mktypes.SpriteDescriptor.SIZE <= n))
+        pos_xy = pos[with_xy]
+        # SpriteEntry records first, SpriteEntryNoXY second.
+        return SpriteColumns(
+            np.concatenate((pos_xy, pos)),
+            np.concatenate((np.zeros(len(pos_xy), dtype=np.int8),
+                            np.ones(len(pos), dtype=np.int8))),
+            np.concatenate((w[pos_xy], w[pos])),
+            np.concatenate((h[pos_xy], h[pos])),
+            np.concatenate((x[with_xy], np.zeros(len(pos), dtype=np.int16))),
+            np.concatenate((y[with_xy], np.zeros(len(pos), dtype=np.int16))),
+            np.concatenate((exec_scan.GatherU32(b, pos_xy + 8),
+                            exec_scan.GatherU32(b, pos + 4))))
+
+    @staticmethod
+    def FromColumns(parts: List[SpriteColumns]) -> 'SpriteTable':
+        '''Merges scan results and restores the scan order inside every
+        file_id group.
+        '''
+        if not parts:
+            return SpriteTable.Empty()
+        c = SpriteColumns(*(np.concatenate(column)
+                            for column in zip(*parts)))
+        file_id = (c.id_offset >> 24).astype(np.uint8)
+        order = np.lexsort((c.variant, c.found_at, file_id))
+        return SpriteTable(c.width[order], c.height[order], c.x[order],
+                           c.y[order], file_id[order],
+                           (c.id_offset & 0xFFFFFF)[order])
+
+    @staticmethod
+    def FromBytes(buffer: memoryview) -> 'SpriteTable':
+        '''Vectorized equivalent of calling SpriteDescriptor.FromBytes at
+        every offset of the buffer.
+        '''
+        return SpriteTable.FromColumns([SpriteTable.ScanColumns(buffer)])
+
+    @staticmethod
+    def Empty() -> 'SpriteTable':
+        return SpriteTable(np.zeros(0, dtype=np.uint16),
+                           np.zeros(0, dtype=np.uint16),
+                           np.zeros(0, dtype=np.int16),
+                           np.zeros(0, dtype=np.int16),
+                           np.zeros(0, dtype=np.uint8),
+                           np.zeros(0, dtype=np.uint32))
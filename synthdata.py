@@ -0,0 +1,194 @@
+'''
+ Mortal Kombat uncompressed GRA files viewer
+ 
+ Copyright (c) 2021 ReWolf
+ http://blog.rewolf.pl/
+ 
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU Lesser General Public License as published
+ by the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+ 
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU Lesser General Public License for more details.
+ 
+ You should have received a copy of the GNU Lesser General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import argparse
+import os
+import struct
+import sys
+from typing import List, Optional, Tuple
+import numpy as np
+import mktypes
+
+# Palette index of transparent pixels in generated sprites.
+TRANSPARENT = -1
+IMAGE_BASE = 0x400000
+
+
+def EncodeRow(row: np.ndarray) -> bytes:
+    '''RLE encodes one row: transparent runs, solid runs of 3+ pixels and
+    literal runs in between (padded to 4 bytes).
+    '''
+    out = bytearray()
+    starts = np.flatnonzero(np.diff(row, prepend=row[0] - 1))
+    lengths = np.diff(starts, append=len(row))
+    literal = bytearray()
+
+    def FlushLiteral() -> None:
+        if literal:
+            out.extend(struct.pack('<I', len(literal) << 2))
+            out.extend(literal)
+            out.extend(b'\x00' * (-len(literal) % 4))
+            literal.clear()
+
+    for start, length in zip(starts.tolist(), lengths.tolist()):
+        value = int(row[start])
+        if value == TRANSPARENT:
+            FlushLiteral()
+            out.extend(struct.pack('<I', (length << 1) | 1))
+        elif length >= 3:
+            FlushLiteral()
+            out.extend(struct.pack('<I', (length << 10) | (value << 2) | 2))
+        else:
+            literal.extend(bytes((value, )) * length)
+    FlushLiteral()
+    return bytes(out)
+
+
+def EncodeSprite(pixels: np.ndarray) -> bytes:
+    '''pixels is a (height, width) array of palette indices or TRANSPARENT.
+    Like the game does, rows after the first one are width & 0xFF pixels
+    wide, so only that part of them is encoded.
+    '''
+    height, width = pixels.shape
+    rows = [EncodeRow(pixels[0])]
+    rows.extend(EncodeRow(row[:width & 0xFF]) for row in pixels[1:])
+    return b''.join(rows)
+
+
+def RandomSprite(rng: np.random.Generator, width: int, height: int,
+                 colors: int) -> np.ndarray:
+    '''Blobs of transparency and runs of repeated colors, roughly like game
+    sprites compress.
+    '''
+    pixels = rng.integers(1, colors, size=(height, width), dtype=np.int16)
+    repeat = rng.random((height, width)) < 0.5
+    repeat[:, 0] = False
+    for x in range(1, width):
+        pixels[:, x] = np.where(repeat[:, x], pixels[:, x - 1], pixels[:, x])
+    pixels[rng.random((height, width)) < 0.25] = TRANSPARENT
+    return pixels
+
+
+class ExecutableBuilder:
+    '''Places records into a random filler buffer one after another.'''
+    def __init__(self, rng: np.random.Generator, size: int) -> None:
+        self.rng = rng
+        self.data = bytearray(rng.integers(0, 256, size, dtype=np.uint8))
+        # zeroed areas and tables of small integers, both are common in
+        # executables and trigger false positives of the scanners
+        for _ in range(size // 40000):
+            pos = int(rng.integers(0, size - 4096))
+            self.data[pos:pos + 4000] = bytes(4000)
+            pos = int(rng.integers(0, size - 4096))
+            self.data[pos:pos + 2000] = rng.integers(0, 8, 2000,
+                                                     dtype=np.uint8).tobytes()
+        self.cursor = size // 10
+
+    def Put(self, record: bytes) -> int:
+        pos = self.cursor
+        assert pos + len(record) <= len(self.data), 'executable too small'
+        self.data[pos:pos + len(record)] = record
+        self.cursor += len(record) + int(self.rng.integers(16, 200))
+        return pos
+
+
+def Generate(directory: str,
+             seed: int = 1,
+             exe_size: int = 2 * 1024 * 1024,
+             files: int = 6,
+             sprites: int = 30,
+             palettes: int = 40) -> Tuple[str, List[str]]:
+    '''Writes directory/MK.EXE and directory/GRAPHICS/FILEnn.GRA, returns
+    their names. The executable contains palettes, a sprite descriptor
+    table for every GRA file (both descriptor variants) and the FileEntry
+    table naming all GRA files.
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(directory, 'GRAPHICS'), exist_ok=True)
+    exe = ExecutableBuilder(rng, exe_size)
+    for _ in range(palettes):
+        count = int(rng.integers(16, 257))
+        colors = rng.choice(0x8000, size=count, replace=False)
+        exe.Put(struct.pack('<H%dH' % count, count, *colors.tolist()))
+
+    gra_files = []
+    for file_id in range(files):
+        name = 'FILE%02d.GRA' % file_id
+        gra = bytearray()
+        descriptors = bytearray()
+        for index in range(sprites):
+            # the first sprite of every file is a wide background
+            width = 300 if index == 0 else int(rng.integers(4, 120))
+            height = int(rng.integers(4, 120))
+            offset = len(gra)
+            gra += EncodeSprite(RandomSprite(rng, width, height, 60))
+            if index % 3:
+                x, y = rng.integers(-50, 50, 2).tolist()
+                descriptors += struct.pack('<HHhhI', width, height, x, y,
+                                           (file_id << 24) | offset)
+            else:
+                descriptors += struct.pack('<HHI', width, height,
+                                           (file_id << 24) | offset)
+        exe.Put(bytes(descriptors))
+        gra_file_name = os.path.join(directory, 'GRAPHICS', name)
+        with open(gra_file_name, 'wb') as f:
+            f.write(gra)
+        gra_files.append(gra_file_name)
+
+    names = [
+        exe.Put(b'GRAPHICS\\' + os.path.basename(f).encode() + b'\x00')
+        for f in gra_files
+    ]
+    # invalid records around the table end the file id counting
+    table = bytearray(b'\xFF' * mktypes.FileEntry.SIZE)
+    for name_pos, gra_file_name in zip(names, gra_files):
+        table += struct.pack('<6I', IMAGE_BASE + name_pos,
+                             os.path.getsize(gra_file_name), 0x12, 0, 0, 0)
+    table += b'\xFF' * mktypes.FileEntry.SIZE
+    exe.Put(bytes(table))
+
+    exe_file_name = os.path.join(directory, 'MK.EXE')
+    with open(exe_file_name, 'wb') as f:
+        f.write(exe.data)
+    return exe_file_name, gra_files
+
+
+def Main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Generates a fake MK executable and GRA files.')
+    parser.add_argument('directory')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--exe-size', type=int, default=2 * 1024 * 1024)
+    parser.add_argument('--files', type=int, default=6)
+    parser.add_argument('--sprites',
+                        type=int,
+                        default=30,
+                        help='sprites per GRA file')
+    parser.add_argument('--palettes', type=int, default=40)
+    args = parser.parse_args(argv)
+    exe_file_name, gra_files = Generate(args.directory, args.seed,
+                                        args.exe_size, args.files,
+                                        args.sprites, args.palettes)
+    print('%s, %d GRA files' % (exe_file_name, len(gra_files)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
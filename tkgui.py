@@ -18,50 +18,158 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-import time
+import argparse
 import os
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import tkinter
 
 from PIL import Image, ImageTk
-from threading import Thread
-from typing import List
+from typing import List, Literal, Optional, Sequence
 
 import graph_util
 import mkexec
 import grafile
 import mktypes
+import animation
+import sprite_grid
+import render_cache
+import exec_loader
+import anim_export
+import atlas
+import profiling
 
 
 class Application(tk.Frame):
     def __init__(self, master=None) -> None:
         tk.Frame.__init__(self, master)
 
-        self.photos: List[ImageTk.PhotoImage] = []
-        self.animation_thread_running = False
-        self.close_when_thread_is_finished = False
+        self.mkexec: Optional[mkexec.MkExec] = None
+        self.loader: Optional[exec_loader.ExecLoader] = None
+        self.gra_file: Optional[grafile.GraFile] = None
+        self.sprites: List[mktypes.SpriteDescriptor] = []
+        self.palettes: List[mktypes.Palette] = []
+        self.palette_matrix = graph_util.PaletteMatrix(dict())
+        self.compositor = graph_util.FrameCompositor()
+        self.render_cache = render_cache.RenderCache()
         self.grid(sticky=tk.N + tk.S + tk.E + tk.W, padx=4, pady=4)
         self.createWidgets()
+        self.setGraWidgetsState(tk.DISABLED)
+        self.animation = animation.AnimationEngine(
+            self.canvas, lambda stats: self.onAnimationStats(stats))
         self.master.protocol('WM_DELETE_WINDOW', lambda: self.onClose())
 
     def onClose(self) -> None:
-        if self.animation_thread_running:
-            self.close_when_thread_is_finished = True
-            self.animation_enabled.set(0)
-        else:
-            self.master.destroy()
+        self.cancelLoading()
+        self.animation.Stop()
+        self.master.destroy()
 
-    def parseMkExecutable(self, filename: str) -> None:
-        self.mkexec = mkexec.MkExec(filename)
+    def cancelLoading(self) -> None:
+        if self.loader is not None:
+            self.loader.Cancel()
 
-    def parseGraFile(self, gra_filename: str) -> None:
-        gra_file = grafile.GraFile(self.mkexec, gra_filename)
+    def parseMkExecutable(self, filename: str) -> None:
+        '''Scanning runs in the background, GRA loading is enabled once it
+        finishes.
+        '''
+        self.cancelLoading()
+        self.closeGraFile()
+        self.palettes = []
+        self.clearListbox(self.listbox_palette)
+        if self.mkexec is not None:
+            self.mkexec.Close()
+            self.mkexec = None
+        self.setGraWidgetsState(tk.DISABLED)
+        self.string_status.set('Loading %s...' % os.path.basename(filename))
+        self.loader = exec_loader.ExecLoader(filename)
+        self.pollLoader(self.loader)
+
+    def pollLoader(self, loader: exec_loader.ExecLoader) -> None:
+        for event in loader.Events():
+            if loader is not self.loader:
+                # superseded by another executable
+                if event.kind == exec_loader.DONE:
+                    event.value.Close()
+                continue
+            if event.kind == exec_loader.PROGRESS:
+                self.string_status.set(
+                    'Scanning %s: %d/%d' %
+                    (event.stage.replace('_', ' '), event.done, event.total))
+            elif event.kind == exec_loader.READY:
+                if event.stage == mkexec.READY_PALETTES:
+                    self.palette_matrix = graph_util.PaletteMatrix(
+                        event.value)
+            elif event.kind == exec_loader.DONE:
+                self.onMkExecutableLoaded(event.value)
+            elif event.kind == exec_loader.FAILED:
+                self.loader = None
+                self.string_status.set('Loading failed: %s' % event.value)
+            elif event.kind == exec_loader.CANCELLED:
+                self.loader = None
+                self.string_status.set('Loading cancelled')
+        if loader.running or not loader.events.empty():
+            self.after(50, lambda: self.pollLoader(loader))
+
+    def onMkExecutableLoaded(self, mkobj: mkexec.MkExec) -> None:
+        self.loader = None
+        self.mkexec = mkobj
+        self.animation.ClearCache()
+        self.render_cache.Clear()
+        self.setGraWidgetsState(tk.NORMAL)
+        self.showOperationCost('%d palettes, %d sprite descriptors' %
+                               (len(mkobj.palettes), len(mkobj.sprite_table)))
+
+    def showOperationCost(self, status: str = '') -> None:
+        '''Adds the cost of the last operation to the status bar while
+        profiling is enabled.
+        '''
+        operation = profiling.LastOperation()
+        if operation is not None:
+            status = (status + ' | ' if status else '') + operation.Summary()
+        if status:
+            self.string_status.set(status)
+
+    def setGraWidgetsState(self,
+                           state: Literal['normal', 'disabled']) -> None:
+        '''GRA file and sprite widgets need a loaded executable.'''
+        for widget in (self.text_gra_file, self.listbox_gra_entries,
+                       self.listbox_palette, self.checkbox_render_all,
+                       self.button_save):
+            widget.configure(state=state)
+
+    def clearListbox(self, listbox: tk.Listbox) -> None:
+        '''Tk ignores deleting items of a disabled listbox, the state is
+        restored afterwards.
+        '''
+        state = listbox.cget('state')
+        listbox.configure(state=tk.NORMAL)
+        listbox.delete(0, tk.END)
+        listbox.configure(state=state)
+
+    def closeGraFile(self) -> None:
+        '''Nothing may decode sprites of the old file after it is closed,
+        the render cache is keyed by sprite offsets of the current file only.
+        '''
+        self.animation.Stop()
+        self.sprite_grid.Clear()
+        self.animation.ClearCache()
+        self.render_cache.Clear()
         self.sprites = []
         self.checkbox_render_all.deselect()
+        # callers set the final state (render all is off now)
+        self.clearListbox(self.listbox_gra_entries)
+        if self.gra_file is not None:
+            self.gra_file.Close()
+            self.gra_file = None
+
+    def parseGraFile(self, gra_filename: str) -> None:
+        assert self.mkexec is not None
+        self.closeGraFile()
+        with profiling.Stage('parseGraFile'):
+            self.gra_file = grafile.GraFile(self.mkexec, gra_filename)
+        self.showOperationCost()
         self.listbox_gra_entries.configure(state=tk.NORMAL)
-        self.listbox_gra_entries.delete(0, tk.END)
-        for s in gra_file.sprites.values():
+        for s in self.gra_file.sprites.values():
             self.sprites.append(s)
             self.listbox_gra_entries.insert(
                 tk.END, '%06x (%d, %d) (%d, %d)' %
@@ -75,6 +183,8 @@ class Application(tk.Frame):
             self.parseMkExecutable(self.string_mk_exe.get())
 
     def loadGraFile(self, event):
+        if self.mkexec is None:
+            return
         filename = filedialog.askopenfilename(
             filetypes=(('GRA files.', '*.GRA'), ),
             initialdir=os.path.join(os.path.dirname(self.string_mk_exe.get()),
@@ -89,40 +199,25 @@ class Application(tk.Frame):
         return mktypes.ImageSize(round(sprite.width * scale),
                                  round(sprite.height * scale))
 
-    def drawBytesOnCanvas(self, img_buffer: List[int], width: int, height: int,
-                          x: int, y: int,
-                          palette: mktypes.Palette) -> mktypes.ImageSize:
-        colored_sprite = graph_util.ApplyPalette(
-            img_buffer, graph_util.PreparePalette(palette.colors))
-        scale = self.scale_slider.get()
-        img = Image.frombuffer('RGB', (width, height), colored_sprite, 'raw',
-                               'RGB', 0, 1).resize((round(width * scale),
-                                                    round(height * scale)))
-        if x == 0 and y == 0:
-            self.photos = []
-        self.photos.append(ImageTk.PhotoImage(img))
-        self.canvas.create_image(x, y, image=self.photos[-1], anchor=tk.NW)
-        return mktypes.ImageSize(*img.size)
-
-    def drawSpriteOnCanvas(self, sprite: mktypes.SpriteDescriptor, x: int,
-                           y: int,
-                           palette: mktypes.Palette) -> mktypes.ImageSize:
-        return self.drawBytesOnCanvas(sprite.data, sprite.width, sprite.height,
-                                      x, y, palette)
+    def renderSprite(self, sprite: mktypes.SpriteDescriptor,
+                     palette: mktypes.Palette,
+                     scale: float) -> ImageTk.PhotoImage:
+        with profiling.Stage('renderSprite', sprite.width * sprite.height):
+            return self.render_cache.Get(sprite, scale,
+                                         self.palette_matrix.Lut(palette))
 
     def updatePaletteFrame(self) -> None:
         palette = self.getSelectedPalette()
-        colors = graph_util.PreparePalette(palette.colors)
+        rgb = self.palette_matrix.Rgb(palette)
         max_color = len(palette.colors)
         for i in range(0, 256):
             if i < max_color:
-                self.palette_boxes[i].configure(
-                    bg='#' + format(colors[i].r, '02x') +
-                    format(colors[i].g, '02x') + format(colors[i].b, '02x'))
+                self.palette_boxes[i].configure(bg='#' +
+                                                rgb[i * 3:i * 3 + 3].hex())
             else:
                 self.palette_boxes[i].configure(bg='white')
 
-    def updatePalettesListBox(self, current_colors: List[int]) -> None:
+    def updatePalettesListBox(self, current_colors: Sequence[int]) -> None:
         self.listbox_palette.delete(0, tk.END)
         selected_index = -1
         for p in self.palettes:
@@ -141,21 +236,16 @@ class Application(tk.Frame):
         if not sprites:
             return
         self.updatePaletteFrame()
+        self.animation.Stop()
         self.canvas.update()
-        canvas_width = self.canvas.winfo_width()
-        max_height = 0
-        current_x = 0
-        current_y = 0
-        for sprite in sprites:
-            scaled_size = self.getScaledSpriteSize(sprite)
-            if current_x + scaled_size.width > canvas_width:
-                current_x = 0
-                current_y += max_height
-            actual_size = self.drawSpriteOnCanvas(sprite, current_x, current_y,
-                                                  self.getSelectedPalette())
-            current_x += actual_size.width
-            if actual_size.height > max_height:
-                max_height = actual_size.height
+        palette = self.getSelectedPalette()
+        scale = self.scale_slider.get()
+        with profiling.Stage('renderSpriteList',
+                             sum(s.width * s.height for s in sprites)):
+            self.sprite_grid.Show(
+                sprites, [self.getScaledSpriteSize(s) for s in sprites],
+                lambda sprite: self.renderSprite(sprite, palette, scale))
+        self.showOperationCost()
 
     def renderAllSprites(self) -> None:
         self.renderSpriteList(self.sprites)
@@ -173,63 +263,63 @@ class Application(tk.Frame):
             return self.palettes[cs[0]]
         return mktypes.Palette([])
 
-    def getCurrentPaletteColors(self) -> List[int]:
+    def getCurrentPaletteColors(self) -> Sequence[int]:
         return self.getSelectedPalette().colors
 
     def saveAnimated(self, filename: str) -> None:
         sprites = self.getSelectedSprites()
-        palette = self.getSelectedPalette()
-        clipping_box = graph_util.CalculateClippingBox(sprites)
-        images = []
-        for s in sprites:
-            buf = graph_util.AddClippingBox(s, clipping_box, -1)
-            colored_sprite = graph_util.ApplyPalette(
-                buf, graph_util.PreparePalette(palette.colors))
-            images.append(
-                Image.frombuffer('RGB',
-                                 (clipping_box.width, clipping_box.height),
-                                 colored_sprite, 'raw', 'RGB', 0, 1))
+        lut = self.palette_matrix.Lut(self.getSelectedPalette())
         try:
-            images[0].save(filename,
-                           save_all=True,
-                           append_images=images[1:],
-                           optimize=True,
-                           duration=round(1000 / self.speed_var.get()),
-                           loop=0)
-        except ValueError as e:
+            anim_export.SaveAnimation(filename, sprites, lut,
+                                      self.speed_var.get())
+        except (ValueError, OSError) as e:
             messagebox.showerror('Error', str(e))
 
-    def animate(self) -> None:
-        self.animation_thread_running = True
-        sprites = self.getSelectedSprites()
+    def renderAnimationFrames(
+            self, sprites: List[mktypes.SpriteDescriptor], scale: float,
+            lut: graph_util.PaletteLut) -> List[render_cache.RenderedImage]:
         clipping_box = graph_util.CalculateClippingBox(sprites)
-
-        sprite_index = 0
-        while self.animation_enabled.get():
-            if sprites:
-                s = sprites[sprite_index]
-                buf = graph_util.AddClippingBox(s, clipping_box, -1)
-                self.drawBytesOnCanvas(buf, clipping_box.width,
-                                       clipping_box.height, 0, 0,
-                                       self.getSelectedPalette())
-                sprite_index += 1
-                sprite_index %= len(sprites)
-            time.sleep(1.0 / self.speed_var.get())
-        self.animation_thread_running = False
+        return [
+            render_cache.RenderedImage.Create(buf, scale, lut)
+            for buf in self.compositor.Compose(sprites, clipping_box)
+        ]
 
     def animateSprites(self) -> None:
-        self.current_sprite_animation_index = 0
-        self.animation_thread = Thread(target=lambda: self.animate())
-        self.animation_thread.start()
+        sprites = self.getSelectedSprites()
+        if not sprites:
+            self.animation.Stop()
+            return
+        lut = self.palette_matrix.Lut(self.getSelectedPalette())
+        scale = self.scale_slider.get()
+        frames = self.animation.GetFrames(
+            (tuple(s.offset for s in sprites), scale),
+            lambda: self.renderAnimationFrames(sprites, scale, lut))
+        for frame in frames:
+            frame.SetPalette(lut)
+        self.sprite_grid.Clear()
+        self.animation.Play([frame.photo for frame in frames],
+                            self.speed_var.get())
+
+    def onAnimationStats(self, stats: animation.PlaybackStats) -> None:
+        self.string_animation_stats.set('FPS: %.1f, dropped frames: %d' %
+                                        (stats.fps, stats.frames_dropped))
+
+    def onSpeedChange(self) -> None:
+        self.animation.SetFps(self.speed_var.get())
+
+    def refreshView(self) -> None:
+        if self.animation_enabled.get():
+            self.animateSprites()
+        else:
+            self.renderSpriteList(self.getSelectedSprites())
 
     def onPaletteSelect(self, event) -> None:
         self.updatePaletteFrame()
-        if not self.animation_enabled.get():
-            self.renderSpriteList(self.getSelectedSprites())
+        self.refreshView()
 
     def updatePaletteListForSprites(
             self, sprites: List[mktypes.SpriteDescriptor]) -> None:
-        if not sprites:
+        if not sprites or self.mkexec is None:
             return
         min_colors = 0
         for sprite in sprites:
@@ -243,17 +333,16 @@ class Application(tk.Frame):
     def onSpriteSelect(self, event) -> None:
         sprites = self.getSelectedSprites()
         self.updatePaletteListForSprites(sprites)
-        self.renderSpriteList(sprites)
+        self.refreshView()
 
     def onScaleChange(self) -> None:
-        if not self.animation_enabled.get():
-            self.renderSpriteList(self.getSelectedSprites())
+        self.refreshView()
 
     def onRenderAllChange(self) -> None:
         if self.render_all.get():
             self.listbox_gra_entries.configure(state=tk.DISABLED)
             self.updatePaletteListForSprites(self.sprites)
-            self.renderAllSprites()
+            self.refreshView()
         else:
             self.listbox_gra_entries.configure(state=tk.NORMAL)
             self.onSpriteSelect(None)
@@ -270,25 +359,32 @@ class Application(tk.Frame):
                 self.listbox_gra_entries.selection_set(cur_sel[0])
 
     def onAnimationChange(self) -> None:
-        if self.animation_enabled.get():
-            self.animateSprites()
-        else:
-            self.renderSpriteList(self.getSelectedSprites())
+        if not self.animation_enabled.get():
+            self.animation.Stop()
+            self.string_animation_stats.set('')
+        self.refreshView()
 
     def saveStatic(self, filename: str) -> None:
+        '''Same packed atlas (and JSON sidecar describing where every
+        sprite went) as mkexport writes.
+        '''
         sprites = self.getSelectedSprites()
-        palette = self.getSelectedPalette()
-        img = graph_util.GetSpritesImage(sprites, palette)
+        if not sprites:
+            return
+        sheet = atlas.BuildAtlas(sprites, self.getSelectedPalette())
         try:
-            img.save(filename)
-        except ValueError as e:
+            atlas.SaveAtlas(sheet, filename)
+        except (ValueError, OSError) as e:
             messagebox.showerror('Error', str(e))
 
     def onSave(self) -> None:
         filename = filedialog.asksaveasfilename(
-            filetypes=(('PNG files.', '*.png'), ('GIF files.', '*.gif')),
+            filetypes=(('PNG files.', '*.png'), ('GIF files.', '*.gif'),
+                       ('WebP files.', '*.webp')),
             initialdir=os.path.join(os.path.dirname(self.string_mk_exe.get()),
                                     'GRAPHICS'))
+        if not filename:
+            return
         if self.animation_enabled.get():
             self.saveAnimated(filename)
         else:
@@ -317,6 +413,7 @@ class Application(tk.Frame):
         self.text_gra_file = tk.Entry(self, textvariable=self.string_gra_file)
         self.text_gra_file.grid(column=1, row=1, columnspan=2, sticky='NEW')
         self.text_gra_file.bind("<Button-1>", lambda e: self.loadGraFile(e))
+        self.text_gra_file.configure(state=tk.DISABLED)
 
         self.pal_sprites_frame = tk.Frame(self)
         self.pal_sprites_frame.grid(column=0, row=2, rowspan=3, sticky='NESW')
@@ -353,8 +450,21 @@ class Application(tk.Frame):
         self.listbox_gra_entries.bind('<<ListboxSelect>>',
                                       lambda e: self.onSpriteSelect(e))
 
-        self.canvas = tk.Canvas(self, bg='#FFFFFF')
-        self.canvas.grid(column=1, row=2, columnspan=3, sticky='NESW')
+        self.canvas_frame = tk.Frame(self)
+        self.canvas_frame.grid(column=1, row=2, columnspan=3, sticky='NESW')
+        self.canvas_frame.rowconfigure(0, weight=1)
+        self.canvas_frame.columnconfigure(0, weight=1)
+        self.canvas = tk.Canvas(self.canvas_frame, bg='#FFFFFF')
+        self.canvas.grid(column=0, row=0, sticky='NESW')
+        self.canvas_yscroll = tk.Scrollbar(self.canvas_frame,
+                                           orient=tk.VERTICAL)
+        self.canvas_yscroll.grid(column=1, row=0, sticky='NS')
+        self.canvas_xscroll = tk.Scrollbar(self.canvas_frame,
+                                           orient=tk.HORIZONTAL)
+        self.canvas_xscroll.grid(column=0, row=1, sticky='EW')
+        self.sprite_grid = sprite_grid.SpriteGridView(self.canvas,
+                                                      self.canvas_yscroll,
+                                                      self.canvas_xscroll)
         self.canvas_image = Image.new("RGB", (0, 0), color=(255, 255, 255))
 
         self.pallette_frame = tk.Frame(self)
@@ -369,6 +479,13 @@ class Application(tk.Frame):
                 box.grid(column=j, row=i, sticky='W')
                 self.palette_boxes.append(box)
 
+        self.string_status = tk.StringVar()
+        self.label_status = tk.Label(self,
+                                     textvariable=self.string_status,
+                                     anchor='w')
+        self.label_status.grid(column=0, row=5, columnspan=4, sticky='WE')
+        self.master.bind('<Escape>', lambda e: self.cancelLoading())
+
         self.control_frame = tk.Frame(self)
         self.control_frame.grid(column=1, row=4, columnspan=2, sticky='NESW')
         self.control_frame.columnconfigure(2, weight=1)
@@ -410,9 +527,19 @@ class Application(tk.Frame):
                                      from_=1,
                                      to=50,
                                      orient=tk.HORIZONTAL,
-                                     variable=self.speed_var)
+                                     variable=self.speed_var,
+                                     command=lambda e: self.onSpeedChange())
         self.speed_slider.grid(column=1, row=2, sticky='W')
 
+        self.string_animation_stats = tk.StringVar()
+        self.label_animation_stats = tk.Label(
+            self.control_frame, textvariable=self.string_animation_stats)
+        # below the save button, which spans rows 0-2 of column 2
+        self.label_animation_stats.grid(column=0,
+                                        row=3,
+                                        columnspan=3,
+                                        sticky='W')
+
         self.button_save = tk.Button(self.control_frame,
                                      text='Save',
                                      padx=25,
@@ -420,6 +547,20 @@ class Application(tk.Frame):
         self.button_save.grid(column=2, row=0, rowspan=3, sticky='NES')
 
 
-app = Application()
-app.master.title('Mortal Kombat GRA viewer')
-app.mainloop()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mortal Kombat GRA viewer')
+    parser.add_argument('--profile',
+                        nargs='?',
+                        const='',
+                        metavar='FILE',
+                        help='show the cost of operations in the status bar, '
+                        'write stage totals and a Chrome trace to FILE')
+    parser.add_argument('--profile-memory',
+                        action='store_true',
+                        help='add tracemalloc peaks to the profile')
+    args = parser.parse_args()
+    if args.profile is not None or args.profile_memory:
+        profiling.Enable(args.profile, args.profile_memory)
+    app = Application()
+    app.master.title('Mortal Kombat GRA viewer')
+    app.mainloop()